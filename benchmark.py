@@ -0,0 +1,306 @@
+#-------------------------------------------------------------------------------
+# Copyright (c) 2017 Yuchen Pei
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#-------------------------------------------------------------------------------
+
+"""
+benchmark vwweb on synthetic wikis of several sizes
+
+    python benchmark.py --pages 100,1000 --keys 1000 --output bench.json
+    python benchmark.py --pages 100,1000 --compare bench.json
+    python benchmark.py --pages 100,1000,5000 --memory
+
+each stage (genlist, navbar, generatereflist, removebrokenlinks, a full assembleall
+and a no-op incremental assembleall) is timed separately and the results saved as json
+
+with --memory the memory allocated while assembling each page is traced instead, and the run
+fails if the median over the pages grows by more than --ceiling times from the smallest number
+of pages to a larger one: a streaming build holds no full copies of the navbar or of a page,
+so the memory a page needs must stay flat as the site grows
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import bib2html
+import vwweb
+
+template = """<html>
+<head>
+<title>%title%</title>
+</head>
+<body>
+<div id="nav">%index%</div>
+<div id="main">
+<h1>%title%</h1>
+%content%
+%references%
+<p>Date: %date%</p>
+</div>
+</body>
+</html>
+"""
+
+words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit',
+         'sed', 'do', 'eiusmod', 'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore']
+
+
+
+def gensite(root, npages, nkeys, seed=0):
+    """
+    generate a synthetic site under root: npages .wiki pages with %title, %date and [{key}]
+    citations, their vimwiki html exports with internal, broken and external links, a
+    template and a bib file with nkeys entries
+    """
+    rnd = random.Random(seed)
+    for d in ('wiki', 'html', 'config'):
+        os.makedirs(os.path.join(root, d))
+    names = ['page%05d' % i for i in range(npages)]
+    keys = ['key%05d' % i for i in range(nkeys)]
+    for i, name in enumerate(names):
+        cites = rnd.sample(keys, min(len(keys), rnd.randint(0, 8)))
+        text = ' '.join(rnd.choice(words) for j in range(rnd.randint(50, 400)))
+        wiki = '%title Page $x_{' + str(i) + '}$ about ' + rnd.choice(words) + '\n'
+        wiki += '%date 2017-01-' + '%02d' % (i % 28 + 1) + '\n'
+        wiki += '= Header =\n' + text + '\n' + ' '.join('[{' + key + '}]' for key in cites) + '\n'
+        with open(os.path.join(root, 'wiki', name + '.wiki'), 'w') as f:
+            f.write(wiki)
+        links = ['<a href="' + rnd.choice(names) + '.html">internal</a>' for j in range(rnd.randint(1, 10))]
+        links.append('<a href="missing' + str(i) + '.html#anchor">broken</a>')
+        links.append('<a href="http://example.com/' + str(i) + '.html">external</a>')
+        html = '<html>\n<head><title>' + name + '</title></head>\n<body>\n'
+        html += '<div id="Header"><h1 id="Header" class="header"><a href="#Header">Header</a></h1></div>\n'
+        html += '<p>\n' + text + '\n' + ' '.join(links) + '\n</p>\n</body>\n</html>\n'
+        with open(os.path.join(root, 'html', name + '.html'), 'w') as f:
+            f.write(html)
+    with open(os.path.join(root, 'config', 'default.tpl'), 'w') as f:
+        f.write(template)
+    with open(os.path.join(root, 'config', 'tw.bib'), 'w') as f:
+        for i, key in enumerate(keys):
+            f.write('@article{' + key + ',\n')
+            f.write('  author = {Doe, John and Smith, Ann},\n')
+            f.write('  title = {A \\emph{Study} of ' + ' '.join(rnd.sample(words, 5)) + '},\n')
+            f.write('  journal = {Journal of ' + rnd.choice(words) + '},\n')
+            f.write('  volume = {' + str(i % 40) + '},\n')
+            f.write('  pages = {1--10},\n')
+            f.write('  year = {' + str(1980 + i % 40) + '}\n}\n\n')
+
+
+
+def usesite(root):
+    """
+    point vwweb at a fresh site under root and drop the bib caches, so nothing of the previous run is reused
+    """
+    vwweb.usesite(vwweb.Site(os.path.join(root, 'html') + '/', os.path.join(root, 'wiki') + '/',
+                             os.path.join(root, 'config') + '/', os.path.join(root, 'config', 'tw.bib'),
+                             os.path.join(root, 'cache') + '/'))
+    bib2html.bibindexes.clear()
+    bib2html.rendercaches.clear()
+    bib2html.rendercachedirty.clear()
+
+
+
+def timed(f, *args):
+    """
+    return the wall time of f(*args) in seconds
+    """
+    t = time.time()
+    f(*args)
+    return time.time() - t
+
+
+
+def benchsite(root, npages, nkeys):
+    """
+    generate a site with npages pages and nkeys bib entries and time each stage on it
+    """
+    gensite(root, npages, nkeys)
+    usesite(root)
+    stages = {}
+    stages['genlist'] = timed(vwweb.genlist)
+    vwweb.buildindex()
+    names = vwweb.getnamelist()
+
+    def navbars():
+        vwweb.buildnavbar()
+        for name in names:
+            vwweb.navbar(name)
+    stages['navbar'] = timed(navbars)
+
+    def reflists():
+        for name in names:
+            vwweb.generatereflist(name)
+    stages['generatereflist'] = timed(reflists)
+    stages['generatereflist_warm'] = timed(reflists)
+
+    contents = [vwweb.vimwikihtml2content(name) for name in names]
+    vwweb.buildknownpages()
+
+    def linkpass():
+        for content in contents:
+            vwweb.removebrokenlinks(content)
+    stages['removebrokenlinks'] = timed(linkpass)
+    del contents
+
+    usesite(root)
+    shutil.rmtree(vwweb.cachedir, True)
+    for f in os.listdir(vwweb.configdir):
+        if f.endswith('.cache'):
+            os.remove(vwweb.configdir + f)
+    stages['assembleall'] = timed(vwweb.assembleall)
+    stages['assembleall_noop'] = timed(vwweb.assembleall, True)
+    return {'pages': npages, 'keys': nkeys, 'stages': stages}
+
+
+
+def memorysite(root, npages, nkeys):
+    """
+    generate a site with npages pages and nkeys bib entries, build it once to load the bib index,
+    template and caches, then build it again with the memory allocated by each assemble() traced,
+    and return the median and the largest of these peaks over the pages
+    """
+    gensite(root, npages, nkeys)
+    usesite(root)
+    vwweb.genlist()
+    vwweb.assembleall()
+    peaks = {}
+    assemble = vwweb.assemble
+
+    def traced(wikiname):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        assemble(wikiname)
+        peaks[wikiname] = tracemalloc.get_traced_memory()[1] - before
+
+    tracemalloc.start()
+    vwweb.assemble = traced
+    try:
+        vwweb.assembleall()
+        total = tracemalloc.get_traced_memory()[1]
+    finally:
+        vwweb.assemble = assemble
+        tracemalloc.stop()
+    ordered = sorted(peaks.values())
+    worst = max(peaks, key=peaks.get)
+    return {'pages': npages, 'keys': nkeys, 'median': ordered[len(ordered) // 2], 'worst': peaks[worst],
+            'page': worst, 'peak': total}
+
+
+
+def memorycheck(args):
+    """
+    run memorysite() at every size and return 1 if the median memory needed per page at any size is
+    more than the ceiling times that at the smallest size; the pages are generated from the same seed
+    at every size, so the result does not change from run to run
+    """
+    status = 0
+    base = None
+    for npages in sorted(int(n) for n in args.pages.split(',')):
+        root = tempfile.mkdtemp(prefix='vwweb-bench-')
+        try:
+            saved = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                r = memorysite(root, npages, args.keys)
+            finally:
+                sys.stdout.close()
+                sys.stdout = saved
+        finally:
+            shutil.rmtree(root, True)
+        if base is None:
+            base = r
+        growth = float(r['median']) / base['median']
+        verdict = 'ok' if growth <= args.ceiling else 'over the ceiling of %.1f' % args.ceiling
+        print('pages=%d keys=%d: median %.1f kB per page, %.2f times that at %d pages (%s), '
+              'worst %.1f kB (%s), build peak %.1f MB' %
+              (npages, args.keys, r['median'] / 1024.0, growth, base['pages'], verdict,
+               r['worst'] / 1024.0, r['page'], r['peak'] / 1048576.0))
+        if growth > args.ceiling:
+            status = 1
+    return status
+
+
+
+def compare(old, new):
+    """
+    print the stage timings of new next to those of old for the sizes both have
+    """
+    oldresults = dict(((r['pages'], r['keys']), r) for r in old['results'])
+    for r in new['results']:
+        o = oldresults.get((r['pages'], r['keys']))
+        if o is None:
+            continue
+        print('pages=%d keys=%d' % (r['pages'], r['keys']))
+        for stage in sorted(r['stages']):
+            if stage in o['stages']:
+                a, b = o['stages'][stage], r['stages'][stage]
+                print('  %-22s %9.4fs %9.4fs %7.2fx' % (stage, a, b, a / b if b > 0 else 0))
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark vwweb on synthetic wikis')
+    parser.add_argument('--pages', default='100,1000',
+                        help='comma separated numbers of pages to benchmark (default 100,1000)')
+    parser.add_argument('--keys', type=int, default=1000, help='number of bib entries (default 1000)')
+    parser.add_argument('--output', help='write the results as json to this file')
+    parser.add_argument('--compare', help='json results of an earlier run to compare against')
+    parser.add_argument('--memory', action='store_true',
+                        help='check that the memory needed per page does not grow with the number of pages '
+                        'instead of timing the stages')
+    parser.add_argument('--ceiling', type=float, default=1.5,
+                        help='largest allowed growth of the median memory needed to assemble a page from the '
+                        'smallest number of pages to a larger one (default 1.5)')
+    args = parser.parse_args()
+    if args.memory:
+        sys.exit(memorycheck(args))
+    results = {'python': platform.python_version(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': []}
+    for npages in [int(n) for n in args.pages.split(',')]:
+        root = tempfile.mkdtemp(prefix='vwweb-bench-')
+        try:
+            saved = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                r = benchsite(root, npages, args.keys)
+            finally:
+                sys.stdout.close()
+                sys.stdout = saved
+        finally:
+            shutil.rmtree(root, True)
+        results['results'].append(r)
+        print('pages=%d keys=%d' % (npages, args.keys))
+        for stage in sorted(r['stages']):
+            print('  %-22s %9.4fs' % (stage, r['stages'][stage]))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.compare:
+        compare(json.load(open(args.compare)), results)
+
+if __name__ == '__main__':
+    main()
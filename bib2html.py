@@ -28,11 +28,9 @@
 # Usage:
 # bib2html [bibfile] [htmlfile]
 # 
-# Currently not a full bibtex parser.
+# Entries are read by a streaming tokenizer which handles brace-delimited
+# and quoted values, multi-line fields, @string macros and @comment.
 # Restrictions:
-#   entries must end with "}" in first column of a new line
-#   no blank lines allowed within an entry
-#   must have space before and after the "=" in the field definitions
 #   limited special symbols (accents etc.)
 #
 # Fields such as author, year, title, ... are marked with <span class=...>
@@ -45,6 +43,9 @@
 # if url is missing and doi is presented a url is created,
 # A pdf field can point to a local pdf file
 #
+# The html of an entry is given by a citation style, a template for each
+# entry type, which can be read from a json file, see loadstyle().
+#
 # Italic text (such as latin species names) may be marked with
 # \emph{ ... } in the bibtex file. This is handled correctly
 # by both bib2html and LaTeX.
@@ -65,6 +66,12 @@ import sys
 import re
 import datetime
 import codecs
+import hashlib
+import itertools
+import json
+import mmap
+import pickle
+import types
 class KeyNotInBib(Exception):
     pass
 
@@ -90,6 +97,16 @@ pdfpath = 'http://mi.eng.cam.ac.uk/~bdrs2/papers/'
 # css style file to use
 css_file = 'style.css'
 
+# bump when the format of the bib caches or of the rendered html changes
+bibcacheversion = 6
+
+# in-memory bib indexes: bib filename -> ((mtime, size), (key -> offsets, key -> hash, macros))
+bibindexes = {}
+
+# rendered references: (bib filename, style digest) -> key -> (entry hash, html), see rendercachekey()
+rendercaches = {}
+rendercachedirty = set()
+
 # html prolog
 # modify according to your needs
 prolog = """<!DOCTYPE HTML
@@ -158,43 +175,176 @@ emph = re.compile(u'''
             (?P<emph_text>([^{}]*{[^{}]*})*.*?)  # (...{...})*...
             }''', re.VERBOSE)               # }
 
+# LaTeX escapes and their html, replaced by cleanlatex()
+# add more if necessary
+latexescapes = {
+    '\\AE': u'Æ',
+    '\\O':  u'Ø',
+    '\\AA': u'Å',
+    '\\ae': u'æ',
+    '\\o':  u'ø',
+    '\\^o': '&ocirc;',
+    '\\aa': u'å',
+    '\\"a': '&auml;',
+    '\\\'a': '&aacute;',
+    '\\\'e': '&eacute;',
+    '\\c{c}': '&ccedil;',
+    '{': '',
+    '}': '',
+    '"': '',
+}
+
+
+
+def compilelatexescapes(escapes):
+    '''Compile the keys of escapes into one regular expression, longest first'''
+    keys = sorted(escapes, key=len, reverse=True)
+    return re.compile('|'.join([re.escape(k) for k in keys]))
+
+# the escapes which are replaced by html, and the ones which are dropped
+latexpattern = compilelatexescapes([k for k in latexescapes if latexescapes[k]])
+latexdeletions = compilelatexescapes([k for k in latexescapes if not latexescapes[k]])
+
+
+
+def latexreplacement(m):
+    return latexescapes[m.group(0)]
+
+
+
+def cleanlatex(v, commandsonly=False):
+    '''Replace the escapes of latexescapes in v, one pass for those with html
+    and one for those which are dropped, or only the first if commandsonly is
+    set. Since the html has nothing to drop, this gives what one pass over
+    both would, without calling latexreplacement() for every brace'''
+    v = latexpattern.sub(latexreplacement, v)
+    return v if commandsonly else latexdeletions.sub('', v)
+
 
 
 # --------------------------------------------------------------------------------
-# class: bibtex entry 
+# class: bibtex entry
 # --------------------------------------------------------------------------------
+
+# fields kept in the values of an Entry, the others go to its extra dict
+fieldnames = ('address', 'annote', 'author', 'booktitle', 'chapter', 'doi', 'edition',
+              'editor', 'howpublished', 'institution', 'isbn', 'issn', 'journal',
+              'keywords', 'month', 'note', 'number', 'organization', 'pages', 'pdf',
+              'publisher', 'school', 'series', 'title', 'url', 'volume', 'year')
+
+# field -> its bit in Entry.present
+fieldbits = dict((name, 1 << i) for i, name in enumerate(fieldnames))
+
+# the extra dict of the entries without other fields, never written to
+noextra = types.MappingProxyType({})
+
 class Entry(object):
-    """Class for bibtex entry"""
+    """Class for bibtex entry
+
+    The values of the common fields (see fieldnames) are kept in one tuple
+    in the order of fieldnames, and present has their bits (see fieldbits),
+    so an entry takes a few words besides its values instead of a
+    per-instance __dict__ or a slot per field. Other fields go to the extra
+    dict, which is the shared empty noextra until one is set. Fields are
+    read as attributes (e.title) and written with set() or setfields().
+    """
+
+    __slots__ = ('type', 'key', 'present', 'values', 'extra')
+
+    def __init__(self):
+        self.type = None
+        self.key = None
+        self.present = 0
+        self.values = ()
+        self.extra = noextra
+
+    def __getattr__(self, name):
+        '''Look up a field'''
+        bit = fieldbits.get(name)
+        if bit is not None:
+            present = self.present
+            if present & bit:
+                return self.values[(present & (bit - 1)).bit_count()]
+        elif name not in Entry.__slots__ and name in self.extra:
+            return self.extra[name]
+        raise AttributeError(name)
+
+    def set(self, name, value):
+        '''Set field name to value'''
+        self.setfields([(name, value)])
+
+    def setfields(self, pairs):
+        '''Set the fields of a list of (name, value) in one go'''
+        common = None
+        for name, value in pairs:
+            if name in fieldbits:
+                if common is None:
+                    common = dict(zip(presentfields(self.present), self.values))
+                common[name] = value
+            elif name == 'type' or name == 'key':
+                setattr(self, name, value)
+            else:
+                if self.extra is noextra:
+                    self.extra = {}
+                self.extra[name] = value
+        if common is not None:
+            present = 0
+            for name in common:
+                present |= fieldbits[name]
+            self.present = present
+            self.values = tuple([common[name] for name in presentfields(present)])
+
+    def setvalues(self, values):
+        '''Give the fields which are set the list of values, in the order of fields()'''
+        i = (self.type is not None) + (self.key is not None)
+        if self.type is not None:
+            self.type = values[0]
+        if self.key is not None:
+            self.key = values[i - 1]
+        n = i + len(self.values)
+        self.values = tuple(values[i : n])
+        if n < len(values):
+            self.extra = dict(zip(self.extra, values[n :]))
+
+    def has(self, name):
+        '''Check whether field name is set'''
+        bit = fieldbits.get(name)
+        if bit is not None:
+            return self.present & bit != 0
+        if name == 'type' or name == 'key':
+            return getattr(self, name) is not None
+        return name in self.extra
+
+    def fields(self):
+        '''Return the list of (name, value) of the fields which are set'''
+        result = [(name, value) for name, value in (('type', self.type), ('key', self.key)) if value is not None]
+        result += zip(presentfields(self.present), self.values)
+        result += self.extra.items()
+        return result
+
+    def copy(self):
+        '''Return a copy of the entry which can be cleaned independently'''
+        e = Entry()
+        e.type, e.key, e.present, e.values = self.type, self.key, self.present, self.values
+        if self.extra is not noextra:
+            e.extra = dict(self.extra)
+        return e
 
     def clean(self):
         '''Clean up an entry'''
-        for k, v in self.__dict__.items():
+        cleaned = []
+        for k, v in self.fields():
 
             # remove leading and trailing whitespace
             v = v.strip()
 
-            # replace special characters - add more if necessary
-            v = v.replace('\\AE', u'Æ')
-            v = v.replace('\\O',  u'Ø')
-            v = v.replace('\\AA', u'Å')
-            v = v.replace('\\ae', u'æ')
-            v = v.replace('\\o',  u'ø')
-            v = v.replace('\\^o',  '&ocirc;')
-            v = v.replace('\\aa', u'å')
-            v = v.replace('\\"a', '&auml;')
-            v = v.replace('\\\'a', '&aacute;')
-            v = v.replace('\\\'e', '&eacute;')
-            v = v.replace('\\c{c}' , '&ccedil;')
-
-            # fix \emph in title
-            if k == 'title':
-                v = re.sub(emph, '<I>\g<emph_text></I>', v)
-
-            # remove "{" and "}"
-            v = v.replace('{', '')
-            v = v.replace('}', '')
-            v = v.replace('"', '')
-        
+            # fix \emph in title, after the escapes whose braces would confuse emph
+            if k == 'title' and '\\emph' in v:
+                v = re.sub(emph, '<I>\g<emph_text></I>', cleanlatex(v, True))
+
+            # replace special characters and remove "{", "}" and '"'
+            v = cleanlatex(v)
+
             # remove trailing comma and dot
             if len(str(v))>0:
               if v[-1] == ',': v = v[:-1]
@@ -247,228 +397,738 @@ class Entry(object):
             if k == 'pages':
                 v = v.replace('--', '&ndash;')
                 v = v.replace('-',  '&ndash;')
-        
-            setattr(self, k, v)
+
+            cleaned.append(v)
+        self.setvalues(cleaned)
         
     # ------------------ 
 
     def write(self):
-        """Write entry to html file"""
+        """Write entry to html file, in the citation style set by usestyle()"""
+        try:
+            return typerenderers[self.type][self.present](self)
+        except KeyError:
+            citations = stylestate['citations']
+            citation = citations.get(self.type) or citations['*']
+            if not citation.extrafields:
+                typerenderers[self.type] = citation.renderers
+            return citation.renderer(self)(self)
 
-        edict = self.__dict__  # bruke
-        
-        result = ''
 
-        # --- Start list ---
-        result += '\n'
-        result += '<li>\n'
-        
-        # --- key ---
-        result += '[' + edict['key'] + '] '
-
-        # --- chapter ---
-        chapter = False
-        if 'chapter' in edict:
-          chapter = True
-          result += '<span class="title">'
-          result += self.chapter
-          result += '</span>'
-          result += ', '
-
-         
-
-        # --- title ---
-        if not(chapter):
-            result += '<span class="title">'
-            result += self.title
-            result += '</span>'
-            result += ', '
-
-
-        # --- author ---
-        result += '<span class="author">'
-        result += self.author
-        result += '</span>'
-        result += ', '
-        
-        # -- if book chapter --
-        if chapter:
-          result += 'in: '
-          result += '<i>'
-          result += self.title
-          result += '</i>'
-          result += ', '
-          result += self.publisher
-
-
-        # --- journal or similar ---
-        journal = False
-        if 'journal' in edict:
-            journal = True
-            result += '<i>'
-            result += self.journal
-            result += '</i>'
-        elif 'booktitle' in edict:
-            journal = True
-            result += edict['booktitle']
-        elif edict['type'] == 'phdthesis':
-            journal = True
-            result += 'PhD thesis, '
-            result += edict['school']
-        elif edict['type'] == 'techreport':
-            journal = True
-            result += 'Tech. Report, '
-            result += edict['number']
-    
-        # --- volume, pages, notes etc ---
-        if 'volume' in edict:
-            result += ', Vol. '
-            result += edict['volume']
-        if ('number' in edict and edict['type']!='techreport'):
-            result += ', No. '
-            result += edict['number']
-        if 'pages' in edict:
-                result += ', p.'
-                result += edict['pages']
-        elif 'note' in edict:
-            if journal or chapter: result += ', '
-            result += edict['note']
-        if 'month' in edict:
-            result += ', '
-            result += self.month
-
-        # --- year ---
-        result += '<span class="year">'
-        #result += ', ';
-        result += ' ';
-        result += self.year
-        result += '</span>'
-        #result += ',\n'
-
-        # final period
-        result += '.'
-
-        # --- Links ---
-        pdf = False
-        url = False
-        if 'pdf' in edict:
-            pdf = True
-        if 'url' in edict or 'doi' in edict:
-            url = True
-
-        if pdf or url:
-            result += ' \n[&nbsp;'
-            if pdf:
-                result += '<a href="'
-                result += pdfpath + self.pdf
-                result += '">pdf</a>&nbsp;'
-                if url:
-                    result += '\n|&nbsp;'
-            if url:
-                result += '<a href="'
-                if 'url' in edict:
-                    result += self.url
-                else:
-                    result += 'http://dx.doi.org/' + self.doi
-                result += '">link</a>&nbsp;'
-            result += ']\n'
 
-        # Terminate the list entry
-        result += '</li>\n'
-        return result
+# present -> the names of the common fields whose bits it has, in order, see presentfields()
+fieldlists = {}
+
+
+
+def presentfields(present):
+    '''Return the names of the common fields whose bits are in present'''
+    names = fieldlists.get(present)
+    if names is None:
+        names = fieldlists[present] = tuple([name for name in fieldnames if present & fieldbits[name]])
+    return names
+
+
+
+# --------------------------------------------------------------------------------
+# citation styles
+# --------------------------------------------------------------------------------
+#
+# A citation style maps an entry type to the template its entries are
+# written with, '*' standing for the types without a template of their own.
+# In a template
+#   {field}     is the value of field, which the entry must have
+#   {?field}    writes nothing, it makes field a condition of its group
+#   {@name}     is the value of the module setting name, such as pdfpath
+#   [[a||b||c]] is the first of a and b whose conditions hold, else c; the
+#               conditions of an alternative are its {?field}s if it has
+#               any, else its {field}s.  A single [[a]] is written if its
+#               conditions hold, and [[a||b||]] has nothing as the last
+#               alternative.
+# A template is compiled into a function for each set of fields it meets, see Citation.
+
+# the parts of the default style shared by all entry types
+citationhead = ('\n<li>\n[{key}] '
+                '[[{?chapter}<span class="title">{chapter}</span>, ||<span class="title">{title}</span>, ]]'
+                '<span class="author">{author}</span>, '
+                '[[{?chapter}in: <i>{title}</i>, {publisher}]]')
+citationtail = ('[[, {month}]]'
+                '<span class="year"> {year}</span>.'
+                '[[{?pdf} \n[&nbsp;<a href="{@pdfpath}{pdf}">pdf</a>&nbsp;'
+                '[[{?url}\n|&nbsp;<a href="{url}">link</a>&nbsp;'
+                '||{?doi}\n|&nbsp;<a href="http://dx.doi.org/{doi}">link</a>&nbsp;||]]]\n'
+                '||{?url} \n[&nbsp;<a href="{url}">link</a>&nbsp;]\n'
+                '||{?doi} \n[&nbsp;<a href="http://dx.doi.org/{doi}">link</a>&nbsp;]\n||]]'
+                '</li>\n')
+
+# the style of bib2html
+defaultstyle = {
+    '*': citationhead + '[[<i>{journal}</i>||{booktitle}||]][[, Vol. {volume}]][[, No. {number}]]'
+         '[[, p.{pages}||{?note}{?journal}, {note}||{?note}{?booktitle}, {note}'
+         '||{?note}{?chapter}, {note}||{note}||]]' + citationtail,
+    'phdthesis': citationhead + '[[<i>{journal}</i>||{booktitle}||PhD thesis, {school}]]'
+                 '[[, Vol. {volume}]][[, No. {number}]][[, p.{pages}||, {note}||]]' + citationtail,
+    'techreport': citationhead + '[[<i>{journal}</i>||{booktitle}||Tech. Report, {number}]]'
+                  '[[, Vol. {volume}]][[, p.{pages}||, {note}||]]' + citationtail,
+}
+
+# the style Entry.write() renders with, its digest and its compiled templates, see usestyle()
+stylestate = {'style': None, 'digest': None, 'citations': None}
+
+# entry type -> Citation.renderers of its template in the style in use, see Entry.write()
+typerenderers = {}
+
+styletoken = re.compile(r'\[\[|\]\]|\|\||\{([?@]?)([A-Za-z_][A-Za-z0-9_]*)\}')
+
+
+
+def parsetemplate(template):
+    '''Parse a citation template into a list of parts: literal strings,
+    (kind, name) for {name}, {?name} and {@name}, with kind '', '?' or '@',
+    and for [[...]] the list of its alternatives, each a list of parts'''
+    # the alternatives of the open groups, the template itself at the bottom
+    stack = [[[]]]
+    pos = 0
+    for m in styletoken.finditer(template):
+        if m.start() > pos:
+            stack[-1][-1].append(template[pos:m.start()])
+        pos = m.end()
+        token = m.group()
+        if token == '[[':
+            stack.append([[]])
+        elif len(stack) == 1 and token in ('||', ']]'):
+            raise ValueError(token + ' outside [[ ]] in citation template ' + repr(template))
+        elif token == '||':
+            stack[-1].append([])
+        elif token == ']]':
+            group = stack.pop()
+            stack[-1][-1].append(group)
+        else:
+            stack[-1][-1].append((m.group(1), m.group(2)))
+    if len(stack) > 1:
+        raise ValueError('unclosed [[ in citation template ' + repr(template))
+    if pos < len(template):
+        stack[0][0].append(template[pos:])
+    return stack[0][0]
+
+
+
+def conditionfields(alternative):
+    '''Return the fields an alternative of a group is written for'''
+    tests = [part[1] for part in alternative if isinstance(part, tuple) and part[0] == '?']
+    if not tests:
+        tests = [part[1] for part in alternative if isinstance(part, tuple) and part[0] == '']
+    return sorted(set(tests), key=tests.index)
+
+
+
+def templatefields(parts):
+    '''Return the set of fields used in parsed template parts'''
+    fields = set()
+    for part in parts:
+        if isinstance(part, list):
+            for alternative in part:
+                fields |= templatefields(alternative)
+        elif isinstance(part, tuple) and part[0] != '@':
+            fields.add(part[1])
+    return fields
+
+
+
+def templatesettings(parts):
+    '''Return the set of settings used in parsed template parts'''
+    settings = set()
+    for part in parts:
+        if isinstance(part, list):
+            for alternative in part:
+                settings |= templatesettings(alternative)
+        elif isinstance(part, tuple) and part[0] == '@':
+            settings.add(part[1])
+    return settings
+
+
+
+# signature -> function making the function which writes the literals and values of an entry
+# whose values have the kinds of signature, see citationfactory()
+citationfactories = {}
+
+
+
+def citationfactory(signature):
+    '''Return the function which, given literals L0..Ln and arguments A0..An-1,
+    makes the function writing L0, the value of kind signature[0] and argument
+    A0, L1 and so on up to Ln for an entry. A value of kind 'v' is the common
+    field with index A in Entry.values, 'x' the other field A, 'k' the key,
+    't' the type and '@' the setting A of this module. There is one such
+    function for each signature rather than for each set of fields, since
+    the signatures are far fewer'''
+    factory = citationfactories.get(signature)
+    if factory is None:
+        names = []
+        pieces = []
+        for i, kind in enumerate(signature):
+            names += ['L%d' % i, 'A%d' % i]
+            pieces.append('{L%d}' % i)
+            pieces.append({'v': '{v[A%d]}', 'x': '{x[A%d]}', 'k': '{entry.key}', 't': '{entry.type}',
+                           '@': '{settings[A%d]}'}[kind].replace('%d', str(i)))
+        names.append('L%d' % len(signature))
+        pieces.append('{L%d}' % len(signature))
+        lines = ['def factory(%s):' % ', '.join(names),
+                 '    def render(entry):']
+        if 'v' in signature:
+            lines.append('        v = entry.values')
+        if 'x' in signature:
+            lines.append('        x = entry.extra')
+        lines += ["        return f'%s'" % ''.join(pieces),
+                  '    return render']
+        namespace = {'settings': globals()}
+        exec(compile('\n'.join(lines) + '\n', '<citation factory>', 'exec'), namespace)
+        factory = citationfactories[signature] = namespace['factory']
+    return factory
+
+
+
+def missingfield(name):
+    '''Return a function raising AttributeError for name, as Entry.__getattr__ does'''
+    def render(entry):
+        raise AttributeError(name)
+    return render
+
+
+
+class Citation(object):
+    """
+    a compiled citation template. An entry is written by a function made for the
+    set of fields it has (Entry.present, and which of the other fields of the
+    template are in its extra dict), where every group of the template is
+    decided and what is left is a sequence of literals and values
+    renderers holds these functions by Entry.present for the templates which
+    use no other fields, see Entry.write()
+    """
+
+    def __init__(self, template, name='*'):
+        self.name = name
+        parts = parsetemplate(template)
+        for setting in templatesettings(parts):
+            if setting not in globals():
+                raise ValueError('unknown setting %s in citation template %r' % (setting, template))
+        self.extrafields = sorted(f for f in templatefields(parts) if f not in fieldbits and f not in ('type', 'key'))
+        self.parts = self.prepare(parts)
+        self.mask = 0
+        for name in templatefields(parts):
+            self.mask |= fieldbits.get(name, 0)
+        self.renderers = {}
+        # (Entry.present, presence of each of extrafields) -> function, with extrafields
+        self.shapes = {}
+        # (the bits of Entry.present in mask, presence of each of extrafields) -> the
+        # result of reduce(), shared by the sets of fields differing outside the template
+        self.reduced = {}
+
+    def renderer(self, entry):
+        '''Return the function writing entry, making it the first time'''
+        if not self.extrafields:
+            render = self.renderers[entry.present] = self.make(entry.present, noextra, ())
+            return render
+        shape = (entry.present,) + tuple([name in entry.extra for name in self.extrafields])
+        render = self.shapes.get(shape)
+        if render is None:
+            render = self.shapes[shape] = self.make(entry.present, entry.extra, shape[1:])
+        return render
+
+    def make(self, present, extra, flags):
+        '''Make the function writing the entries with the fields of present and extra,
+        flags telling which of extrafields extra has'''
+        key = (present & self.mask, flags)
+        out = self.reduced.get(key)
+        if out is None:
+            out = []
+            missing = self.reduce(self.parts, present, extra, out)
+            if missing is not None:
+                out = missing
+            self.reduced[key] = out
+        if isinstance(out, str):
+            return missingfield(out)
+        literals = ['']
+        signature = []
+        arguments = []
+        for part in out:
+            if isinstance(part, str):
+                literals[-1] += part
+                continue
+            kind, name = part
+            if kind == '@':
+                signature.append('@')
+                arguments.append(name)
+            elif name in fieldbits:
+                signature.append('v')
+                arguments.append((present & (fieldbits[name] - 1)).bit_count())
+            elif name == 'key' or name == 'type':
+                signature.append(name[0])
+                arguments.append(None)
+            else:
+                signature.append('x')
+                arguments.append(name)
+            literals.append('')
+        values = []
+        for literal, argument in zip(literals, arguments):
+            values += [literal, argument]
+        values.append(literals[-1])
+        return citationfactory(tuple(signature))(*values)
+
+    def prepare(self, parts):
+        '''Turn each group of parsed template parts into a list of (mask, extra, parts,
+        final) for its alternatives: the bits of the common fields and the other
+        fields it is written for, unless final is set for the last one'''
+        prepared = []
+        for part in parts:
+            if isinstance(part, list):
+                group = []
+                for i, alternative in enumerate(part):
+                    tests = conditionfields(alternative)
+                    mask = 0
+                    for name in tests:
+                        mask |= fieldbits.get(name, 0)
+                    extra = [name for name in tests if name not in fieldbits and name not in ('type', 'key')]
+                    group.append((mask, extra, self.prepare(alternative), i == len(part) - 1 > 0))
+                part = group
+            prepared.append(part)
+        return prepared
+
+    def reduce(self, parts, present, extra, out):
+        '''Append to out the literals and the (kind, name) of the values which
+        prepared parts write for the entries with the fields of present and extra,
+        or return the name of a field they need and do not have'''
+        for part in parts:
+            if isinstance(part, str):
+                out.append(part)
+            elif isinstance(part, list):
+                for mask, names, alternative, final in part:
+                    if final or present & mask == mask and all(name in extra for name in names):
+                        missing = self.reduce(alternative, present, extra, out)
+                        if missing is not None:
+                            return missing
+                        break
+            elif part[0] == '@':
+                out.append(part)
+            elif part[0] == '':
+                if not self.has(part[1], present, extra):
+                    return part[1]
+                out.append(part)
+        return None
+
+    def has(self, name, present, extra):
+        bit = fieldbits.get(name)
+        if bit is not None:
+            return present & bit != 0
+        return name in ('type', 'key') or name in extra
+
+
+
+def compilestyle(style):
+    '''Compile a citation style into a dict entry type -> Citation'''
+    if '*' not in style:
+        raise ValueError("citation style without a '*' template")
+    return dict((name, Citation(template, name)) for name, template in style.items())
+
+
+
+def styledigest(style):
+    '''Hash of a citation style'''
+    return hashlib.sha1(json.dumps(style, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+
+def usestyle(style):
+    '''Write entries in style from now on'''
+    digest = styledigest(style)
+    if digest == stylestate['digest']:
+        return
+    stylestate.update({'style': style, 'digest': digest, 'citations': compilestyle(style)})
+    typerenderers.clear()
+
+
+
+def loadstyle(filename):
+    '''Read a citation style from a json file holding an object entry type -> template'''
+    with codecs.open(filename, 'r', 'utf-8') as f:
+        style = json.load(f)
+    if not isinstance(style, dict) or not all(isinstance(v, str) for v in style.values()):
+        raise ValueError(filename + ': a citation style is an object entry type -> template')
+    return style
+
+
+
+usestyle(defaultstyle)
 
 
 
 # --------------------------------------------------------------------------------
 # generator: bibtex reader
 # --------------------------------------------------------------------------------
-def bib_reader(filename):
-    '''Generator for iteration over entries in a bibtex file'''
 
-    fid = open(filename)
+# start of a record: @type{key or @type(key
+recordstart = re.compile(br'@\s*([A-Za-z]+)\s*([{(])\s*([^,\s{}()"=#]*)')
+braces = re.compile(br'[{}]')
+parens = re.compile(br'[{}()"]')
+nonbraces = bytes(c for c in range(256) if c not in b'{}')
+# a bare word after = or #, which may be an @string macro
+macroreference = re.compile(br'[=#]\s*([A-Za-z][^\s,#{}()"]*)')
 
-    while True:
 
-        # skip irrelevant lines
-        while True:
-            line = fid.next()
-            if len(line) > 0:
-                if line[0] == '@': break           # Found entry
-
-        # Handle entry
-        if line[0] == '@':
-            e = Entry()
-
-            # entry type mellon @ og {
-            words = line.split('{')
-            e.type = words[0][1:].lower()
-            #print e.type + '\n'
-
-            # Iterate through the fields of the entry
-            first_field = True
-            while True: 
-                line = fid.next()
-                #print line + '\n'
-                words = line.split()
-                
-                if words[0] == "}": # end of entry
-                    # store last field
-                    setattr(e, fieldname, fieldtext)
+
+def bibrecords(data):
+    '''Generator over the records of bibtex data (bytes or mmap), yielding
+    (type, key, start, end) with the byte offsets of each record.
+
+    Text between records is skipped as BibTeX does. The end of a record is
+    the brace bringing the depth back to 0, found with a fast path running
+    the depth over the braces up to the next "@" in C.'''
+    pos = 0
+    size = len(data)
+    while True:
+        m = recordstart.search(data, pos)
+        if m is None:
+            return
+        start = m.start(0)
+        opening = m.start(2)
+        end = None
+        if m.group(2) == b'{':
+            n = recordstart.search(data, m.end(0))
+            limit = n.start(0) if n is not None else size
+            # '{' counts -1 and '}' +1, so the record ends at the first 0
+            kept = data[opening : limit].translate(None, nonbraces)
+            depths = list(itertools.accumulate(map((124).__rsub__, kept)))
+            if 0 in depths:
+                closing = next(itertools.islice(braces.finditer(data, opening), depths.index(0), None))
+                end = closing.end(0)
+            else:
+                depth = 0
+                for d in braces.finditer(data, opening):
+                    depth += 1 if d.group(0) == b'{' else -1
+                    if depth == 0:
+                        end = d.end(0)
+                        break
+        else:
+            depth = 0
+            quoted = False
+            for d in parens.finditer(data, opening + 1):
+                c = d.group(0)
+                if c == b'{':
+                    depth += 1
+                elif c == b'}':
+                    depth -= 1
+                elif c == b'"' and depth == 0:
+                    quoted = not quoted
+                elif c == b')' and depth == 0 and not quoted:
+                    end = d.end(0)
+                    break
+        if end is None:
+            return  # unterminated record
+        yield m.group(1).decode('ascii').lower(), m.group(3).decode('utf-8', 'replace'), start, end
+        pos = end
+
+
+
+recordhead = re.compile(r'@\s*([A-Za-z]+)\s*([{(])\s*')
+recordkey = re.compile(r'([^,\s{}()"=#]*)\s*')
+fieldname = re.compile(r'\s*,?\s*([^\s=,{}()"#]+)\s*=\s*')
+barevalue = re.compile(r'[^\s,#{}()"]+')
+valuechars = re.compile(r'[{}"]')
+concatenation = re.compile(r'\s*#\s*')
+whitespace = re.compile(r'\s+')
+
+
+
+def parserecord(text, macros):
+    '''Parse the text of a record into (type, key, [(fieldname, value)]).
+
+    Values may be brace-delimited, quoted, numbers or @string macros
+    joined by "#", and may span several lines; runs of whitespace are
+    collapsed to one space. Unknown macros (such as month names) are kept
+    as they are.'''
+    m = recordhead.match(text)
+    kind = m.group(1).lower()
+    pos = m.end(0)
+    if kind in ('comment', 'preamble'):
+        return kind, None, []
+    key = None
+    if kind != 'string':
+        mk = recordkey.match(text, pos)
+        key = mk.group(1)
+        pos = mk.end(0)
+    fields = []
+    while True:
+        mf = fieldname.match(text, pos)
+        if mf is None:
+            break
+        name = mf.group(1).lower()
+        pos = mf.end(0)
+        parts = []
+        while pos < len(text):
+            c = text[pos]
+            if c == '{' or c == '"':
+                # the value ends at the matching brace, or at the next quote outside braces
+                depth = 0
+                for d in valuechars.finditer(text, pos + 1):
+                    ch = d.group(0)
+                    if ch == '{':
+                        depth += 1
+                    elif ch == '}':
+                        if depth == 0 and c == '{':
+                            break
+                        depth -= 1
+                    elif depth == 0 and c == '"':
+                        break
+                else:
+                    d = None
+                q = d.start(0) if d is not None else len(text)
+                parts.append(text[pos + 1 : q])
+                pos = q + 1
+            else:
+                mb = barevalue.match(text, pos)
+                if mb is None:
                     break
+                word = mb.group(0)
+                parts.append(macros.get(word.lower(), word))
+                pos = mb.end(0)
+            mc = concatenation.match(text, pos)
+            if mc is None:
+                break
+            pos = mc.end(0)
+        fields.append((name, whitespace.sub(' ', ''.join(parts))))
+    return kind, key, fields
+
+
+
+def entryfromrecord(text, macros):
+    '''Build an Entry from the text of a record, or return None if the
+    record is not an entry (@string, @comment, @preamble); @string
+    definitions are added to macros'''
+    kind, key, fields = parserecord(text, macros)
+    if kind == 'string':
+        for name, value in fields:
+            macros[name] = value
+        return None
+    if key is None:
+        return None
+    e = Entry()
+    e.type = kind
+    e.key = key
+    e.setfields(fields)
+    return e
 
-                if len(words) > 1 and words[1] == "=": # new field
-                    # store previous field
-                    if not first_field:
-                        setattr(e, fieldname, fieldtext)
-                    else:
-                        first_field = False
-                    #inline = True
-                    fieldname = words[0].lower()
-                    fieldtext = " ".join(words[2:]) # remains a text
 
-                else:  # continued line
-                    fieldtext = " ".join([fieldtext] + words)
-                
-        yield e
-        
+
+def openbib(filename):
+    '''Return the content of a bib file as a read-only memory map, or
+    as bytes if it is empty'''
+    f = open(filename, 'rb')
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        return b''
+    finally:
+        f.close()
+
+
+
+def bib_reader(filename):
+    '''Generator for iteration over entries in a bibtex file'''
+    data = openbib(filename)
+    macros = {}
+    for kind, key, start, end in bibrecords(data):
+        e = entryfromrecord(data[start : end].decode('utf-8', 'replace'), macros)
+        if e is not None:
+            yield e
+
 
 
 def locateinbib(fn, key):
-    data = open(fn).read()
-    m = re.search('^@.*{' + key + ',\s*$', data, re.MULTILINE)
-    if m is not None:
-        ps = m.start(0) #position of start of a bib record
-        pattern = re.compile('^}$', re.MULTILINE)
-        pe = pattern.search(data, ps).start(0) #position of end of a bib record
-        return ps, pe
-    else:
+    '''Return the byte offsets (start, end) of the record of key in fn'''
+    index = loadbibindex(fn)
+    if key not in index:
         raise KeyNotInBib
+    return index[key]
 
 
 
 def bibquery(fn, key):
+    '''Look up key in the bib index of fn and parse its record, returning
+    a fresh Entry'''
     ps, pe = locateinbib(fn, key)
-    data = open(fn).read()
-    lines = data[ps : pe].split('\n')
-    e = Entry()
-    e.key = key
-    e.type = re.search('@(\w+){', lines[0]).group(1).lower()
-    for s in lines[1:-1]:
-        fieldname = re.search('^\s*(\w+?)\s*=', s).group(1).lower()
-        fieldtext = re.search('=\s*(.*)\s*', s).group(1)
-        setattr(e, fieldname, fieldtext)
-    return e
+    with open(fn, 'rb') as f:
+        f.seek(ps)
+        text = f.read(pe - ps).decode('utf-8', 'replace')
+    return entryfromrecord(text, dict(loadbib(fn)[2]))
+
+
+
+def parsebib(fn):
+    '''Scan a bibtex file in one pass into a dict of key -> (start, end)
+    byte offsets of its record, a dict of key -> hash of the raw text of
+    the record together with the values of the @string macros it uses, a
+    dict of the @string macros and a dict of key -> entry type'''
+    data = openbib(fn)
+    index = {}
+    hashes = {}
+    uses = {}
+    macros = {}
+    kinds = {}
+    for kind, key, start, end in bibrecords(data):
+        if kind == 'string':
+            entryfromrecord(data[start : end].decode('utf-8', 'replace'), macros)
+        elif kind not in ('comment', 'preamble') and key not in index:
+            index[key] = (start, end)
+            hashes[key] = hashlib.sha1(data[start : end])
+            words = macroreference.findall(data, start, end)
+            if words:
+                uses[key] = set(w.decode('utf-8', 'replace').lower() for w in words)
+            kinds[key] = kind
+    for key, h in hashes.items():
+        for name in sorted(uses.get(key, ())):
+            if name in macros:
+                h.update(('\0' + name + '=' + macros[name]).encode('utf-8'))
+        hashes[key] = h.hexdigest()
+    return index, hashes, macros, kinds
+
+
+
+def bibcachefile(fn):
+    '''Name of the on-disk cache of the bib index of fn'''
+    return fn + '.cache'
+
+
+
+def loadbibindex(fn):
+    '''Return the key -> (start, end) index of fn.
+
+    The index is kept in memory and in bibcachefile(fn), both validated
+    against the mtime and size of fn, so the bib file is only rescanned
+    after it changes.'''
+    return loadbib(fn)[0]
+
+
+
+def bibentryhash(fn, key):
+    '''Return the hash of the raw bib text of key in fn and of the macros
+    it uses'''
+    hashes = loadbib(fn)[1]
+    if key not in hashes:
+        raise KeyNotInBib
+    return hashes[key]
+
+
+
+def bibentrytype(fn, key):
+    '''Return the entry type of key in fn, such as article'''
+    kinds = loadbib(fn)[3]
+    if key not in kinds:
+        raise KeyNotInBib
+    return kinds[key]
+
+
+
+def loadbib(fn):
+    '''Return the (key -> offsets, key -> hash, macros, key -> type) indexes
+    of fn, see loadbibindex'''
+    st = os.stat(fn)
+    stamp = (st.st_mtime, st.st_size)
+    cached = bibindexes.get(fn)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    indexes = None
+    try:
+        with open(bibcachefile(fn), 'rb') as f:
+            c = pickle.load(f)
+        if c['version'] == bibcacheversion and c['stamp'] == stamp:
+            indexes = c['indexes']
+    except Exception:
+        pass
+    if indexes is None:
+        indexes = parsebib(fn)
+        try:
+            with open(bibcachefile(fn), 'wb') as f:
+                pickle.dump({'version': bibcacheversion, 'stamp': stamp, 'indexes': indexes},
+                            f, pickle.HIGHEST_PROTOCOL)
+        except (IOError, OSError):
+            pass
+    bibindexes[fn] = (stamp, indexes)
+    return indexes
 
 
 
 def htmlfrombibkey(fn, key):
+    '''Return the html list item of key, reusing the rendered reference
+    cache as long as the raw bib text of the entry and the macros it uses
+    are unchanged'''
     try:
-        e = bibquery(fn, key)
-        e.clean()
-        return e.write()
+        h = bibentryhash(fn, key)
     except KeyNotInBib:
         print('can not find ' + key + ' in bib!')
         return '\n<li>[' + key + ']</li>\n'
+    refs = loadrendercache(fn)
+    hit = refs.get(key)
+    if hit is not None and hit[0] == h:
+        return hit[1]
+    e = bibquery(fn, key)
+    e.clean()
+    html = e.write()
+    refs[key] = (h, html)
+    rendercachedirty.add(rendercachekey(fn))
+    return html
+
+
+
+def rendercachekey(fn):
+    '''Key of the references of fn rendered in the citation style in use, so
+    sites sharing a bib file in different styles keep a cache each'''
+    return fn, stylestate['digest']
+
+
+
+def rendercachefile(cachekey):
+    '''Name of the on-disk cache of rendered references of rendercachekey()'''
+    fn, digest = cachekey
+    return fn + '.' + digest[:12] + '.html.cache'
+
+
+
+def loadrendercache(fn):
+    '''Return the key -> (entry hash, html) cache of the references of fn
+    rendered in the citation style in use'''
+    cachekey = rendercachekey(fn)
+    refs = rendercaches.get(cachekey)
+    if refs is None:
+        refs = {}
+        try:
+            with open(rendercachefile(cachekey), 'rb') as f:
+                c = pickle.load(f)
+            if c['version'] == bibcacheversion and c.get('style') == cachekey[1]:
+                refs = c['refs']
+        except Exception:
+            pass
+        rendercaches[cachekey] = refs
+    return refs
+
+
+
+def saverendercache(fn):
+    '''Write the rendered references of fn back to disk, in each style any were
+    added in, dropping keys which are no longer in the bib file'''
+    index = None
+    for cachekey in sorted(k for k in rendercachedirty if k[0] == fn):
+        if index is None:
+            index = loadbibindex(fn)
+        refs = rendercaches[cachekey]
+        for key in [k for k in refs if k not in index]:
+            del refs[key]
+        try:
+            with open(rendercachefile(cachekey), 'wb') as f:
+                pickle.dump({'version': bibcacheversion, 'style': cachekey[1], 'refs': refs}, f,
+                            pickle.HIGHEST_PROTOCOL)
+            rendercachedirty.discard(cachekey)
+        except (IOError, OSError):
+            pass
 
 
 
@@ -539,31 +1199,31 @@ def main():
   f1.write('<h2>Journals</h2>');
   f1.write('\n<ol reversed>\n\n')
   for e in journallist:
-    e.write(f1)
+    f1.write(e.write())
   f1.write('\n</ol>\n\n')
 
   f1.write('<h2>Conferences and Workshops</h2>');
   f1.write('\n<ol reversed>\n\n')
   for e in conflist:
-    e.write(f1)
+    f1.write(e.write())
   f1.write('\n</ol>\n\n')
 
   f1.write('<h2>Book Chapters</h2>');
   f1.write('\n<ol reversed>\n\n')
   for e in bookchapterlist:
-    e.write(f1)
+    f1.write(e.write())
   f1.write('\n</ol>\n\n')
 
   f1.write('<h2>Technical Reports</h2>');
   f1.write('\n<ol reversed>\n\n')
   for e in techreportlist:
-    e.write(f1)
+    f1.write(e.write())
   f1.write('\n</ol>\n\n')
 
   f1.write('<h2>Thesis</h2>');
   f1.write('\n<ol reversed>\n\n')
   for e in thesislist:
-    e.write(f1)
+    f1.write(e.write())
   f1.write('\n</ol>\n\n')
     
   # write epilog
@@ -0,0 +1,234 @@
+#-------------------------------------------------------------------------------
+# Copyright (c) 2017 Yuchen Pei
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#-------------------------------------------------------------------------------
+
+"""
+minify html chunk by chunk, as a page is written
+
+each run of whitespace in text and between tags becomes a single space, or a newline if the
+run held one, whitespace between the attributes of a tag is collapsed the same way, and
+comments are dropped except conditional ones (<!--[if ...]>). the contents of <pre>, <code>,
+<textarea>, <script> and <style>, and inline and display math between \\( \\) and \\[ \\],
+are passed through untouched. only ascii whitespace is collapsed, never &nbsp; or U+00A0.
+"""
+
+import re
+
+# bumped whenever the output for the same html changes, so pages are minified again
+version = 1
+
+# elements whose contents are passed through as they are
+rawtags = ['pre', 'code', 'textarea', 'script', 'style']
+
+# delimiters of math, which is passed through as it is
+mathdelimiters = {'\\(': '\\)', '\\[': '\\]'}
+
+textpattern = re.compile('[^<\\\\ \t\n\r\f]+')
+spacepattern = re.compile('[ \t\n\r\f]+')
+tagpattern = re.compile('<(/?)([a-zA-Z][^ \t\n\r\f/>]*)((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>')
+# what may still become a tag once the next chunk comes
+partialtagpattern = re.compile('</?(?:[a-zA-Z][^ \t\n\r\f/>]*(?:[^>"\']|"[^"]*"|\'[^\']*\')*(?:"[^"]*|\'[^\']*)?)?\\Z')
+declarationpattern = re.compile('<[!?][^>]*>')
+attributespacepattern = re.compile('("[^"]*"|\'[^\']*\')|[ \t\n\r\f]+')
+
+# end -> compiled case insensitive pattern finding it, see Minifier.passthrough()
+endpatterns = {}
+
+# chunk -> what feeding it from text gives, for the chunks repeated on every page such as the
+# blocks of the navbar and the template literals; a chunk is kept once its hash is seen twice,
+# and both are dropped when they hold more than memolimit characters
+memo = {}
+seen = set()
+memostate = {'size': 0}
+memolimit = 1 << 24
+memominimum = 256
+
+
+
+def minify(chunks):
+    """
+    minify a page given as a list of chunks, returning the minified chunks and the number of bytes saved
+    """
+    m = Minifier()
+    out = [m.feed(chunk) for chunk in chunks]
+    out.append(m.close())
+    return [chunk for chunk in out if chunk], m.saved
+
+
+
+def remember(chunk, result):
+    """
+    keep the result of feeding chunk from text if chunk was seen before
+    """
+    h = hash(chunk)
+    if h not in seen:
+        seen.add(h)
+        return
+    if memostate['size'] + len(chunk) > memolimit:
+        memo.clear()
+        seen.clear()
+        memostate['size'] = 0
+    memo[chunk] = result
+    memostate['size'] += len(chunk)
+
+
+
+class Minifier(object):
+    """
+    a streaming minifier: feed() takes the chunks of a page one by one and returns what of the
+    page cannot change anymore, holding back only the few characters which may continue into the
+    next chunk (a run of whitespace, a tag, the start of a comment or an end delimiter)
+    saved counts the bytes, in utf-8, dropped so far
+    """
+
+    def __init__(self):
+        self.buffer = ''
+        # what ends the passage being passed through or dropped, None in text
+        self.end = None
+        self.drop = False
+        self.saved = 0
+
+    def feed(self, chunk):
+        """
+        minify the next chunk of the page
+        """
+        if self.buffer or self.end is not None or len(chunk) < memominimum:
+            self.buffer += chunk
+            return self.run(False)
+        result = memo.get(chunk)
+        if result is None:
+            saved = self.saved
+            self.buffer = chunk
+            result = (self.run(False), self.buffer, self.end, self.drop, self.saved - saved)
+            remember(chunk, result)
+        else:
+            self.buffer, self.end, self.drop = result[1 : 4]
+            self.saved += result[4]
+        return result[0]
+
+    def close(self):
+        """
+        minify what is left of the page
+        """
+        return self.run(True)
+
+    def run(self, final):
+        data = self.buffer
+        n = len(data)
+        out = []
+        pos = 0
+        while pos < n:
+            if self.end is not None:
+                pos = self.passthrough(data, pos, final, out)
+                if self.end is not None:
+                    break
+                continue
+            c = data[pos]
+            if c == '<':
+                end = self.markup(data, pos, final, out)
+                if end is None:
+                    break
+                pos = end
+            elif c == '\\':
+                if pos + 1 == n and not final:
+                    break
+                delimiter = data[pos : pos + 2]
+                if delimiter in mathdelimiters:
+                    out.append(delimiter)
+                    self.end = mathdelimiters[delimiter]
+                    pos += 2
+                else:
+                    out.append(c)
+                    pos += 1
+            elif c in ' \t\n\r\f':
+                m = spacepattern.match(data, pos)
+                if m.end() == n and not final:
+                    break
+                space = m.group()
+                out.append('\n' if '\n' in space else ' ')
+                self.saved += len(space) - 1
+                pos = m.end()
+            else:
+                m = textpattern.match(data, pos)
+                out.append(m.group())
+                pos = m.end()
+        self.buffer = data[pos :]
+        return ''.join(out)
+
+    def markup(self, data, pos, final, out):
+        """
+        minify the tag, comment or declaration at pos, returning the position after it, or None
+        if it may continue into the next chunk
+        """
+        if data.startswith('<!--', pos):
+            if len(data) - pos < 7 and not final:
+                return None
+            if data.startswith('<!--[if', pos):
+                out.append('<!--')
+            else:
+                self.drop = True
+                self.saved += 4
+            self.end = '-->'
+            return pos + 4
+        m = tagpattern.match(data, pos)
+        if m is None:
+            if not final and (partialtagpattern.match(data, pos) or
+                              data[pos + 1 : pos + 2] in ('!', '?', '') and data.find('>', pos) == -1):
+                return None
+            m = declarationpattern.match(data, pos)
+            if m is None:
+                out.append('<')
+                return pos + 1
+            out.append(m.group())
+            return m.end()
+        attributes = attributespacepattern.sub(lambda a: a.group(1) or ' ', m.group(3)).rstrip(' ')
+        tag = '<' + m.group(1) + m.group(2) + attributes + '>'
+        self.saved += len(m.group()) - len(tag)
+        out.append(tag)
+        name = m.group(2).lower()
+        if m.group(1) == '' and name in rawtags and not attributes.endswith('/'):
+            self.end = '</' + name
+        return m.end()
+
+    def passthrough(self, data, pos, final, out):
+        """
+        pass data from pos through, or drop it inside a comment, up to and including self.end;
+        the closing tag of a raw element is left to markup(). return where to go on from
+        """
+        pattern = endpatterns.get(self.end)
+        if pattern is None:
+            pattern = endpatterns[self.end] = re.compile(re.escape(self.end), re.IGNORECASE)
+        m = pattern.search(data, pos)
+        if m is None:
+            stop = len(data) if final else max(pos, len(data) - len(self.end) + 1)
+            end = stop
+        else:
+            stop = m.start() if self.end.startswith('</') else m.end()
+            end = stop
+            self.end = None
+        passage = data[pos : stop]
+        if self.drop:
+            self.saved += len(passage.encode('utf-8'))
+            if self.end is None:
+                self.drop = False
+        else:
+            out.append(passage)
+        return end
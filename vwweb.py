@@ -21,84 +21,1292 @@
 #-------------------------------------------------------------------------------
 
 from os import listdir, path
+import argparse
+import bib2html
+import builtins
+import collections
+import concurrent.futures
 import datetime
+import functools
+import hashlib
+import html
+import htmlmin
+import http.server
+import json
+import locale
+import multiprocessing
+import os
 import pydoc
+import sys
+import threading
 import time
+import tracemalloc
+import traceback
+import urllib.parse
+import wiki2html
+import zlib
 from bib2html import *
+try:
+    import resource
+except ImportError:
+    resource = None
 
 htmldir = '../toywiki/html/'
 wikidir = '../toywiki/wiki/'
 configdir = '../toywiki/config/'
 bibfilename = '../toywiki/config/tw.bib'
+cachedir = '../toywiki/cache/'
+
+plaintexttag = '%%<!-- -*- mode: text; -*- -->\n'
+
+# wikiname -> {'title', 'date', 'keys'}, filled by buildindex() once per build
+pageindex = {}
+
+# {'blocks', 'spans'}: the navbar with all entries linked, filled by buildnavbar()
+navcache = {}
+
+# compiled default.tpl: {'stamp', 'hash', 'segments'}, see gettemplate()
+templatecache = {}
+
+# inputs and outputs of the last build, see loadmanifest()
+manifestversion = 1
+manifest = {}
+
+# wikinames of all wikis under wikidir, and the bibliography if it is written, see buildknownpages()
+knownpages = set()
+
+# {'out', 'in'}: wikiname -> sorted list of wikinames, see buildlinkgraph()
+linkgraph = {'out': {}, 'in': {}}
+
+anchorpattern = re.compile('<a href(.*?)>(.*?)</a>', re.DOTALL)
+schemepattern = re.compile('[a-zA-Z][a-zA-Z0-9+.-]*:')
+
+# filename -> hash of the file as read during this build, so writeoutput() need not read it again
+diskhashes = {}
+
+# wikiname -> %content% made before its page is rendered, so pagecontent() need not make it again
+contentcache = {}
+
+# {'site', 'pages', 'memory'}: stage -> measurements of the build when profiling is on, and the peaks
+# of the running stages, or None unless memory is traced, see runstage(); None when off
+profile = None
+
+# files opened and bytes read and written through countingopen() while profiling
+iocounters = {'opens': 0, 'read': 0, 'written': 0}
+
+# whether the build writes a client side search index to htmldir/search/, see writesearchindex()
+searchindex = False
+tagpattern = re.compile('<[^>]*>')
+termpattern = re.compile('\\w\\w+')
+
+# zlib level of the .gz sidecars written next to every output, None for no sidecars, see gzipoutput()
+gziplevel = None
+
+# key -> wikinames citing it, in the order of the wikilist, see buildcitations()
+citations = {}
+
+# whether the build writes a bibliography of the cited entries to htmldir, see writebibliography()
+bibliography = False
+bibliographyname = 'bibliography'
+
+# sections of the bibliography as in bib2html.main(): heading and entry types, None for all other types
+bibliographysections = [
+    ('Journals', ['article']),
+    ('Conferences and Workshops', ['inproceedings']),
+    ('Book Chapters', ['inbook']),
+    ('Technical Reports', ['techreport']),
+    ('Thesis', ['phdthesis']),
+    ('Other', None),
+]
+
+# whether %content% is converted from the .wiki files by wiki2html rather than taken from the vimwiki exports
+nativeconverter = False
+
+# whether pages are minified by htmlmin between rendering and writing, see writeminified()
+minifyhtml = False
+
+# whether pages carry a reference to one shared navigation, htmldir/nav.json, instead of the
+# whole navbar, see navfiles(); its entries are grouped by the parts of the wikinames
+sharednav = False
+navseparators = re.compile('[/:_-]')
+
+# {'pool', 'jobs', 'all', 'threads'}: the threads compressing outputs while pages are assembled, the
+# pending compressions, whether every sidecar is redone because the level changed since the last build,
+# and how many threads the pool has, 0 to compress in place as worker processes do
+gzipstate = {'pool': None, 'jobs': [], 'all': False, 'threads': os.cpu_count() or 1}
+
+
+
+class Site(object):
+    """
+    the configuration of one wiki: its directories, bib file and cache and the options of its build,
+    together with the objects holding the state of its build (page index, navbar, template, manifest,
+    ...), see usesite(); options maps the names in Site.options to their values, which default to
+    the module level ones
+    the parsed bib files are kept by bib2html per bib file and the rendered references per bib file
+    and citation style, so sites sharing a bib file share them
+    """
+    paths = ['htmldir', 'wikidir', 'configdir', 'bibfilename', 'cachedir']
+    options = ['searchindex', 'gziplevel', 'nativeconverter', 'bibliography', 'minifyhtml', 'sharednav']
+    state = ['pageindex', 'navcache', 'templatecache', 'manifest', 'knownpages', 'linkgraph',
+             'diskhashes', 'contentcache', 'citations']
+
+    def __init__(self, htmldir, wikidir, configdir, bibfilename, cachedir, options=None):
+        self.htmldir = htmldir
+        self.wikidir = wikidir
+        self.configdir = configdir
+        self.bibfilename = bibfilename
+        self.cachedir = cachedir
+        options = options or {}
+        for name in options:
+            if name not in Site.options:
+                raise ValueError('unknown site option ' + name)
+        for name in Site.options:
+            setattr(self, name, options.get(name, globals()[name]))
+        self.pageindex = {}
+        self.navcache = {}
+        self.templatecache = {}
+        self.manifest = {}
+        self.knownpages = set()
+        self.linkgraph = {'out': {}, 'in': {}}
+        self.diskhashes = {}
+        self.contentcache = {}
+        self.citations = {}
+
+    def __repr__(self):
+        return 'Site(%r)' % self.htmldir
+
+
+
+def currentsite():
+    """
+    return the site the functions of this module work on, sharing its state objects with them
+    """
+    site = Site.__new__(Site)
+    for name in Site.paths + Site.options + Site.state:
+        setattr(site, name, globals()[name])
+    return site
+
+
+
+def usesite(site):
+    """
+    make the functions of this module work on site and return the site they worked on so far
+    the paths, options and state objects of site replace the module level ones, so switching between sites
+    neither copies nor drops any cache, and switching back continues where the site was left
+    """
+    previous = currentsite()
+    g = globals()
+    for name in Site.paths + Site.options + Site.state:
+        g[name] = getattr(site, name)
+    return previous
+
+
+
+def directory(d):
+    """
+    return d with a trailing /, as the module level directories are joined by concatenation
+    """
+    return d if d.endswith('/') else d + '/'
+
+
+
+# keys of a site in the file read by loadsites() -> the option of Site they set
+siteoptions = {'search': 'searchindex', 'gzip': 'gziplevel', 'native': 'nativeconverter',
+               'bibliography': 'bibliography', 'minify': 'minifyhtml', 'sharednav': 'sharednav'}
+
+
+
+def loadsites(filename):
+    """
+    read the sites listed in the json file filename: a list of objects with the keys html, wiki,
+    config, bib and cache, where root stands for root/html, root/wiki, root/config and root/cache
+    and bib defaults to bibfilename, the bibliography the sites share; paths are relative to the
+    directory of filename. the keys in siteoptions set the options of a site, which otherwise
+    are those given on the command line
+    """
+    with open(filename) as f:
+        specs = json.load(f)
+    base = os.path.dirname(filename)
+    sites = []
+    for spec in specs:
+        root = spec.get('root')
+        dirs = []
+        for name in ('html', 'wiki', 'config', 'cache'):
+            if name in spec:
+                dirs.append(directory(os.path.join(base, spec[name])))
+            elif root is not None:
+                dirs.append(directory(os.path.join(base, root, name)))
+            else:
+                raise ValueError('%s: a site needs either root or %s' % (filename, name))
+        bib = os.path.join(base, spec['bib']) if 'bib' in spec else bibfilename
+        options = dict((siteoptions[k], spec[k]) for k in spec if k in siteoptions)
+        sites.append(Site(dirs[0], dirs[1], dirs[2], bib, dirs[3], options))
+    return sites
+
 
 
 def assemble(wikiname):
     """
     assemble the html given a wikiname
     """
-    content = vimwikihtml2content(wikiname)
-    template = open(configdir + 'default.tpl', 'r')
-    data = template.read()
-    data = data.replace('%title%', gettitle(wikiname))
-    data = data.replace('%title%', gettitle(wikiname))
-    data = data.replace('%index%', navbar(wikiname))
-    data = data.replace('%content%',content)
-    data = data.replace('%references%', generatereflist(wikiname))
-    data = data.replace('%date%', getdate(wikiname))
-    data = removebrokenlinks(data)
+    chunks, values = render(wikiname)
     htmlname = wikiname + '.html'
-    htmlfile = open(htmldir + htmlname, 'w')
-    htmlfile.write(data)
+    entry = manifestentry(wikiname)
+    if minifyhtml:
+        chunks, entry['minified'] = runstage('minify', wikiname, htmlmin.minify, chunks)
+    else:
+        entry.pop('minified', None)
+    entry['output'] = runstage('writeoutput', wikiname, writeoutput, htmldir + htmlname, chunks)
+    entry['meta'] = getmeta(wikiname)
+    entry['refs'] = refhashes(wikiname)
+    entry['html'] = filestamp(htmldir + htmlname)
+    if 'backlinks' in values:
+        entry['backlinks'] = linkgraph['in'].get(wikiname, [])
+    if searchindex:
+        content = values['content'] if 'content' in values else ''
+        terms = runstage('pageterms', wikiname, pageterms, wikiname, content)
+        entry['terms'] = saveterms(wikiname, terms, entry.get('terms'))
+
+
+
+def render(wikiname):
+    """
+    render the html of wikiname from the template without writing it, returning the page
+    as a list of chunks and a dict placeholder name -> html of the placeholders it used
+    the page is never joined into one string: the chunks are the literals of the template and
+    the placeholder values, which may themselves be lists of chunks like the navbar, so a page
+    costs little memory beyond its placeholders
+    """
+    def value(name):
+        f = placeholders[name]
+        html = runstage(f.__name__, wikiname, f, wikiname)
+        if name not in checkedplaceholders:
+            html = runstage('removebrokenlinks', wikiname, removebrokenlinks, html)
+        return html
+    return filltemplate(value)
+
+
+
+def filltemplate(value):
+    """
+    fill the template with value(name) for each placeholder name, see render()
+    """
+    segments = gettemplate()['segments']
+    values = {}
+    chunks = [segments[0]]
+    for i in range(1, len(segments), 2):
+        name = segments[i]
+        if name not in values:
+            values[name] = value(name)
+        if isinstance(values[name], list):
+            chunks.extend(values[name])
+        else:
+            chunks.append(values[name])
+        chunks.append(segments[i + 1])
+    return chunks, values
+
+
+
+def pagecontent(wikiname):
+    """
+    the %content% of wikiname with broken links stripped, recording its links in the manifest
+    """
+    if wikiname in contentcache:
+        return contentcache.pop(wikiname)
+    if nativeconverter:
+        content = runstage('wikicontent', wikiname, wikicontent, wikiname)
+    else:
+        content = runstage('vimwikihtml2content', wikiname, vimwikihtml2content, wikiname)
+    return runstage('removebrokenlinks', wikiname, removebrokenlinks, content, wikiname)
+
+
+
+def backlinks(wikiname):
+    """
+    assemble the list of pages linking to wikiname from the link graph
+    """
+    names = linkgraph['in'].get(wikiname, [])
+    if names == []:
+        return ''
+    items = ['<li><a href="' + n + '.html">' + gettitle(n) + '</a></li>' for n in names]
+    return '<h2>Pages linking here</h2><ul>' + ''.join(items) + '</ul>'
+
+
+
+def buildlinkgraph():
+    """
+    build the adjacency lists of the links between pages from the links recorded in the manifest
+    linkgraph['out'] maps a wikiname to the pages it links to and linkgraph['in'] to the pages linking to it
+    """
+    outlinks = {}
+    inlinks = {}
+    pages = manifest['pages']
+    for name in iternames():
+        targets = pages.get(name, {}).get('links', [])
+        outlinks[name] = targets
+        for target in targets:
+            inlinks.setdefault(target, []).append(name)
+    for names in inlinks.values():
+        names.sort()
+    linkgraph['out'] = outlinks
+    linkgraph['in'] = inlinks
+
+
+
+def writelinkreport():
+    """
+    write the broken links and the orphaned pages, which no other page links to, to cachedir/links.json
+    """
+    pages = manifest['pages']
+    broken = {}
+    for name in sorted(linkgraph['out']):
+        targets = pages.get(name, {}).get('broken', [])
+        if targets != []:
+            broken[name] = targets
+    orphans = [name for name in sorted(linkgraph['out']) if name != 'index' and name not in linkgraph['in']]
+    ensuredir(cachedir)
+    with open(cachedir + 'links.json', 'w') as f:
+        json.dump({'broken': broken, 'orphans': orphans}, f, indent=1, sort_keys=True)
+    print('Links: %d broken links on %d pages, %d orphaned pages' % (sum([len(t) for t in broken.values()]), len(broken), len(orphans)))
+
+
+
+def pageterms(wikiname, content):
+    """
+    tokenize the title, the citation keys and the text of the %content% of wikiname
+    into a dict term -> number of occurrences, terms being lowercased words of two or more characters
+    """
+    meta = getmeta(wikiname)
+    text = html.unescape(tagpattern.sub(' ', meta['title'] + ' ' + content)).lower()
+    terms = {}
+    for term in termpattern.findall(text):
+        terms[term] = terms.get(term, 0) + 1
+    for key in meta['keys']:
+        key = key.lower()
+        terms[key] = terms.get(key, 0) + 1
+    return terms
+
+
+
+def termsname(wikiname):
+    """
+    file in cachedir keeping the terms of wikiname for the search index, see saveterms()
+    """
+    return cachedir + 'terms/' + wikiname + '.json'
+
+
+
+def saveterms(wikiname, terms, previous):
+    """
+    keep the terms of wikiname in termsname(wikiname) rather than in the manifest, which is written
+    whole on every build, and return their hash for the manifest entry; the file is only rewritten
+    when the hash differs from previous
+    """
+    data = json.dumps(terms, separators=(',', ':'), sort_keys=True)
+    h = digest(data)
+    if h != previous or not path.isfile(termsname(wikiname)):
+        ensuredir(cachedir + 'terms/')
+        with open(termsname(wikiname), 'w') as f:
+            f.write(data)
+    return h
+
+
+
+def writesearchindex(namelist):
+    """
+    write the search index of the pages in namelist, from the terms kept by saveterms(), to htmldir/search/:
+    pages.json lists [wikiname, title] by page number, and the postings of the terms starting with
+    the same two characters go to one shard <prefix>.json as term -> [page, count, page, count, ...],
+    so a browser only fetches the shards of the words searched for; search.js does that
+    only shards whose content changed are rewritten
+    """
+    dirname = htmldir + 'search/'
+    ensuredir(dirname)
+    shards = {}
+    for i, name in enumerate(namelist):
+        if not path.isfile(termsname(name)):
+            continue
+        with open(termsname(name), 'r') as f:
+            terms = json.load(f)
+        for term, count in terms.items():
+            shards.setdefault(term[: 2], {}).setdefault(term, []).extend([i, count])
+    files = {}
+    files['pages.json'] = json.dumps([[name, gettitle(name)] for name in namelist], separators=(',', ':'))
+    files['search.js'] = searchscript
+    for prefix in shards:
+        files[prefix + '.json'] = json.dumps(shards[prefix], separators=(',', ':'), sort_keys=True)
+    outputs = manifest.setdefault('files', {})
+    for f in files:
+        outputs['search/' + f] = writeoutput(dirname + f, files[f])
+    for f in listdir(dirname):
+        if f.endswith('.json') and f not in files:
+            removeoutput(dirname + f)
+            outputs.pop('search/' + f, None)
+
+
+
+def removesearchindex():
+    """
+    remove the search index written by an earlier build with searchindex set
+    """
+    for f in [f for f in manifest.get('files', {}) if f.startswith('search/')]:
+        forgetoutput(f)
+
+
+
+def forgetoutput(f):
+    """
+    remove the output f, relative to htmldir, of an earlier build and drop it from manifest['files']
+    """
+    if path.isfile(htmldir + f):
+        removeoutput(htmldir + f)
+    manifest['files'].pop(f, None)
+
+
+
+# the loader of the search index written by writesearchindex(): vwwebsearch(query, callback)
+# calls callback with the [wikiname, title] of the pages having a word starting with every word
+# of query, best matches first
+searchscript = r'''var vwwebsearch = (function () {
+  var base = document.currentScript.src.replace(/[^\/]*$/, ''), cache = {};
+  function fetchjson(name) {
+    if (!(name in cache)) {
+      cache[name] = fetch(base + encodeURIComponent(name) + '.json')
+        .then(function (r) { return r.ok ? r.json() : {}; }, function () { return {}; });
+    }
+    return cache[name];
+  }
+  return function (query, callback) {
+    var words = query.toLowerCase().match(/[\w]{2,}/g) || [];
+    Promise.all([fetchjson('pages')].concat(words.map(function (w) { return fetchjson(w.slice(0, 2)); })))
+      .then(function (r) {
+        var scores = null;
+        words.forEach(function (w, i) {
+          var shard = r[i + 1], s = {};
+          Object.keys(shard).forEach(function (term) {
+            if (term.lastIndexOf(w, 0) != 0) return;
+            for (var j = 0; j < shard[term].length; j += 2) {
+              s[shard[term][j]] = (s[shard[term][j]] || 0) + shard[term][j + 1];
+            }
+          });
+          if (scores !== null) {
+            Object.keys(s).forEach(function (p) { if (!(p in scores)) delete s[p]; else s[p] += scores[p]; });
+          }
+          scores = s;
+        });
+        var hits = Object.keys(scores || {}).sort(function (a, b) { return scores[b] - scores[a]; });
+        callback(hits.map(function (p) { return r[0][p]; }));
+      });
+  };
+})();
+'''
+
+
 
 def generatereflist(wikiname):
     keys = generatekeylist(wikiname)
     if keys != []:
-        result = '<h2>References</h2><ul>'
-        for key in keys:
-            result += htmlfrombibkey(bibfilename, key)
-        result += '</ul>'
-        return result
+        return '<h2>References</h2><ul>' + ''.join([htmlfrombibkey(bibfilename, key) for key in keys]) + '</ul>'
     return ''
 
+
+
 def generatekeylist(wikiname):
-    data = open(wikidir + wikiname + '.wiki', 'r').read()
-    bibkeylist = list(set(re.findall('\[\{(.*?)\}\]', data)))
-    bibkeylist.sort()
-    return bibkeylist
+    return list(getmeta(wikiname)['keys'])
+
+
 
 def generateallkeylist():
-    bibkeylist = []
-    namelist = getnamelist()
-    for name in namelist:
-        bibkeylist += generatekeylist(name)
-    bibkeylist = list(set(bibkeylist))
-    bibkeylist.sort()
-    return bibkeylist
+    if not citations:
+        buildcitations()
+    return sorted(citations)
+
+
+
+def buildcitations():
+    """
+    build the inverted index of citations, key -> wikinames citing it, from the page index in one pass
+    """
+    index = {}
+    for name in iternames():
+        for key in getmeta(name)['keys']:
+            index.setdefault(key, []).append(name)
+    citations.clear()
+    citations.update(index)
+
+
+
+def writecitations():
+    """
+    write the inverted index of citations to cachedir/citations.json
+    """
+    ensuredir(cachedir)
+    with open(cachedir + 'citations.json', 'w') as f:
+        json.dump(citations, f, indent=1, sort_keys=True)
+
+
+
+def writeminified(namelist):
+    """
+    write the bytes minifying saved on each page to cachedir/minify.json and print their total
+    """
+    saved = dict((name, manifest['pages'][name]['minified']) for name in namelist
+                 if 'minified' in manifest['pages'].get(name, {}))
+    ensuredir(cachedir)
+    with open(cachedir + 'minify.json', 'w') as f:
+        json.dump(saved, f, indent=1, sort_keys=True)
+    print('Minify: %d bytes saved on %d pages' % (sum(saved.values()), len(saved)))
+
+
+
+def writebibliography():
+    """
+    write every cited entry of the bib file to htmldir/bibliographyname.html, grouped by entry type
+    as bib2html.main() does and in the order of the bib file, each followed by links to the pages
+    citing it; the page is rendered with the template like a wiki page
+    the entries come from the rendered reference cache, so each is rendered at most once
+    """
+    filename = bibliographyname + '.html'
+    if bibliographyname in pageindex:
+        print('Warning: a wiki is named ' + bibliographyname + ', not writing the bibliography!')
+        return
+    index = loadbibindex(bibfilename)
+    sections = [[] for section in bibliographysections]
+    for key in citations:
+        try:
+            kind = bibentrytype(bibfilename, key)
+        except KeyNotInBib:
+            sections[-1].append((len(index), key))
+            continue
+        i = [n for n, (heading, kinds) in enumerate(bibliographysections) if kinds is None or kind in kinds][0]
+        sections[i].append((index[key][0], key))
+    content = []
+    for (heading, kinds), entries in zip(bibliographysections, sections):
+        if entries == []:
+            continue
+        content.append('<h2>' + heading + '</h2>\n<ol reversed>\n\n')
+        for pos, key in sorted(entries):
+            html = htmlfrombibkey(bibfilename, key)
+            end = html.rfind('</li>')
+            end = len(html) if end == -1 else end
+            content += [html[: end], citedby(key), html[end :]]
+        content.append('\n</ol>\n\n')
+    dates = [getdate(name) for names in citations.values() for name in names]
+    values = {'title': 'Bibliography', 'index': navbar(bibliographyname), 'content': content,
+              'references': '', 'date': max(dates) if dates else '', 'backlinks': ''}
+    chunks = filltemplate(lambda name: values[name])[0]
+    if minifyhtml:
+        chunks = htmlmin.minify(chunks)[0]
+    manifest.setdefault('files', {})[filename] = writeoutput(htmldir + filename, chunks)
+
+
+
+def citedby(key):
+    """
+    links to the pages citing key, for its entry in the bibliography
+    """
+    links = ['<a href="' + name + '.html">' + gettitle(name) + '</a>' for name in citations[key]]
+    return '<br>Cited in: ' + ', '.join(links) + '\n'
+
+
 
 def getnamelist():
     """
     return the list of wikinames
     """
-    namelistfile = open(configdir + 'wikilist', 'r')
-    namelist = []
-    while True:
-        name = namelistfile.readline().replace('\n', '')
-        if name == '':
-            break
-        else:
-            namelist += [name]
-    return namelist
+    return list(iternames())
+
+
 
+def iternames():
+    """
+    generate the wikinames one by one from the wikilist
+    """
+    with open(configdir + 'wikilist', 'r') as namelistfile:
+        for line in namelistfile:
+            name = line.replace('\n', '')
+            if name == '':
+                break
+            yield name
 
 
-def assembleall():
+
+def assembleall(incremental=False, jobs=1):
     """
     assemble all html pages in the namelist
+    if incremental is set, only the pages whose inputs changed since the last build are assembled
+    with jobs > 1 the pages are assembled by a pool of jobs processes
+    a page which fails does not stop the build; the errors are printed and returned as a dict wikiname -> traceback
     """
+    if profile is not None:
+        profile['site'].clear()
+        profile['pages'].clear()
+        start = time.perf_counter()
+    if manifest.get('version') != manifestversion:
+        runstage('loadmanifest', None, loadmanifest)
+    runstage('loadcitationstyle', None, loadcitationstyle)
+    runstage('buildindex', None, buildindex)
+    runstage('buildcitations', None, buildcitations)
+    runstage('buildnavbar', None, buildnavbar)
+    runstage('buildknownpages', None, buildknownpages)
+    site = runstage('sitehashes', None, sitehashes)
+    gzipstate['all'] = manifest.get('gzip') != gziplevel
     namelist = getnamelist()
+    previous = outputhashes()
+    todo = [name for name in namelist if not (incremental and uptodate(name, site))]
+    contentcache.clear()
+    if 'backlinks' in gettemplate()['segments'][1::2]:
+        # every page's links are needed before the first page is rendered; the contents are kept for it
+        for name in todo:
+            contentcache[name] = runstage('pagecontent', name, pagecontent, name)
+        buildlinkgraph()
+        todo += [name for name in namelist if name not in set(todo) and
+                 manifest['pages'][name].get('backlinks') != linkgraph['in'].get(name, [])]
+    if jobs > 1 and len(todo) > 1:
+        errors = assembleparallel(todo, jobs)
+    else:
+        errors = {}
+        for name in todo:
+            error = tryassemble(name)
+            if error is not None:
+                errors[name] = error
     for name in namelist:
-        assemble(name)
-        addplaintexttag(name)
+        if name in errors:
+            manifestentry(name)['html'] = None
+        else:
+            runstage('addplaintexttag', name, addplaintexttag, name)
+    for name in set(manifest['pages']) - set(namelist):
+        forgetpage(name)
+    runstage('buildlinkgraph', None, buildlinkgraph)
+    runstage('writelinkreport', None, writelinkreport)
+    if searchindex:
+        runstage('writesearchindex', None, writesearchindex, namelist)
+    else:
+        removesearchindex()
+    if sharednav:
+        runstage('writenav', None, writenav)
+    else:
+        removenav()
+    runstage('writecitations', None, writecitations)
+    if minifyhtml:
+        runstage('writeminified', None, writeminified, namelist)
+    if bibliography:
+        runstage('writebibliography', None, writebibliography)
+    elif bibliographyname + '.html' in manifest.get('files', {}):
+        forgetoutput(bibliographyname + '.html')
+    runstage('finishgzip', None, finishgzip)
+    if gziplevel is None and gzipstate['all']:
+        # sidecars were turned off since the last build
+        for f in outputhashes():
+            if f.endswith('.gz') and path.isfile(htmldir + f):
+                os.remove(htmldir + f)
+    manifest.update(site)
+    runstage('saverendercache', None, saverendercache, bibfilename)
+    runstage('savemanifest', None, savemanifest)
+    runstage('writedelta', None, writedelta, previous)
+    for name in sorted(errors):
+        print('Error: failed to assemble ' + name + '\n' + errors[name])
+    if profile is not None:
+        writeprofile(time.perf_counter() - start)
+    return errors
+
+
+
+def tryassemble(wikiname):
+    """
+    assemble wikiname, returning the traceback as a string if it fails
+    """
+    try:
+        runstage('assemble', wikiname, assemble, wikiname)
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+
+
+def assembleparallel(namelist, jobs):
+    """
+    assemble the pages in namelist with a pool of jobs processes
+    the page index, navbar, manifest and bib index are computed once here and handed to the workers,
+    and a content made here already goes with its page;
+    what the workers record in the manifest and the rendered reference cache is merged back in order
+    """
+    state = {'pageindex': pageindex, 'navcache': navcache, 'manifest': manifest, 'knownpages': knownpages,
+             'linkgraph': linkgraph, 'bibindexes': bibindexes, 'rendercaches': rendercaches,
+             'profile': None if profile is None else profile['memory'] is not None,
+             'gzip': gzipstate['all'], 'style': stylestate['style'],
+             'site': dict((name, globals()[name]) for name in Site.paths + Site.options)}
+    pool = multiprocessing.Pool(jobs, initworker, (state,))
+    errors = {}
+    try:
+        chunksize = max(1, len(namelist) // (jobs * 4))
+        pages = ((name, contentcache.pop(name, None)) for name in namelist)
+        for name, entry, refs, error, stages in pool.imap(assembleworker, pages, chunksize):
+            if stages is not None:
+                # the content of name may have been made here before
+                mergestages(profile['pages'].setdefault(name, {}), stages)
+            if error is not None:
+                errors[name] = error
+                continue
+            manifest['pages'][name] = entry
+            cache = loadrendercache(bibfilename)
+            for key in refs:
+                if cache.get(key) != refs[key]:
+                    cache[key] = refs[key]
+                    rendercachedirty.add(rendercachekey(bibfilename))
+    finally:
+        pool.close()
+        pool.join()
+    return errors
+
+
+
+def initworker(state):
+    """
+    install the shared read-only build state in a worker process
+    """
+    globals().update(state['site'])
+    pageindex.update(state['pageindex'])
+    navcache.update(state['navcache'])
+    manifest.update(state['manifest'])
+    knownpages.update(state['knownpages'])
+    linkgraph.update(state['linkgraph'])
+    bibindexes.update(state['bibindexes'])
+    usestyle(state['style'])
+    rendercaches.update(state['rendercaches'])
+    # the workers compress in parallel with each other already, so each compresses its pages itself
+    gzipstate.update({'pool': None, 'jobs': [], 'all': state['gzip'], 'threads': 0})
+    if state['profile'] is not None:
+        startprofile(state['profile'])
+
+
+
+def assembleworker(page):
+    """
+    assemble the page (wikiname, its content or None) in a worker process, returning what the
+    parent needs to record: (wikiname, manifest entry, rendered references of the cited keys,
+    traceback or None, profiled stages of wikiname or None)
+    """
+    wikiname, content = page
+    if content is not None:
+        contentcache[wikiname] = content
+    error = tryassemble(wikiname)
+    refs = loadrendercache(bibfilename)
+    cited = dict((key, refs[key]) for key in getmeta(wikiname)['keys'] if key in refs)
+    stages = profile['pages'].pop(wikiname, {}) if profile is not None else None
+    return wikiname, manifestentry(wikiname), cited, error, stages
+
+
+
+def uptodate(wikiname, site):
+    """
+    check whether wikiname.html from the last build is still valid, namely the
+    template and the navbar are unchanged, the title, date, citations and the
+    cited bib entries of wikiname are unchanged, and htmldir holds our own output
+    rather than a fresh vimwiki export
+    """
+    entry = manifest['pages'].get(wikiname)
+    if entry is None or 'output' not in entry or entry.get('html') is None:
+        return False
+    if searchindex and ('terms' not in entry or not path.isfile(termsname(wikiname))):
+        return False
+    for k in site:
+        if manifest.get(k) != site[k]:
+            return False
+    if gziplevel is not None and not sidecarcurrent(htmldir + wikiname + '.html'):
+        return False
+    if nativeconverter and entry.get('native') != nativestamp(wikiname):
+        return False
+    return (entry['html'] == filestamp(htmldir + wikiname + '.html') and
+            entry['meta'] == getmeta(wikiname) and
+            entry['refs'] == refhashes(wikiname))
+
+
+
+def sitehashes():
+    """
+    hash the inputs shared by all pages: the template, the navbar, which
+    covers the wikilist and every title unless the navigation is shared, the known
+    pages links are checked against and the citation style
+    """
+    return {'template': gettemplate()['hash'], 'nav': 'shared' if sharednav else digest(navcache['blocks']),
+            'known': digest('\n'.join(sorted(knownpages))), 'gzip': gziplevel,
+            'converter': wiki2html.version if nativeconverter else None,
+            'minify': htmlmin.version if minifyhtml else None, 'style': stylestate['digest']}
+
+
+
+def loadcitationstyle():
+    """
+    write the references in the citation style of configdir/citationstyle.json, or in the
+    default style of bib2html if there is none
+    """
+    filename = configdir + 'citationstyle.json'
+    usestyle(loadstyle(filename) if path.isfile(filename) else defaultstyle)
+
+
+
+def gettemplate():
+    """
+    return the compiled default.tpl, compiling it again only when the file changed
+    """
+    stamp = filestamp(configdir + 'default.tpl')
+    if templatecache.get('stamp') != stamp:
+        data = open(configdir + 'default.tpl', 'r').read()
+        templatecache['segments'] = compiletemplate(data)
+        templatecache['hash'] = digest(data)
+        templatecache['stamp'] = stamp
+    return templatecache
+
+
+
+def compiletemplate(data):
+    """
+    split a template into a list alternating literal text and placeholder names,
+    e.g. '<h1>%title%</h1>' becomes ['<h1>', 'title', '</h1>'], so that a page is
+    rendered by a single join
+    unknown placeholders are reported and kept as literal text
+    links in the template are checked here once rather than on every page
+    """
+    data = removebrokenlinks(data)
+    segments = []
+    literal = ''
+    pos = 0
+    pattern = re.compile('%(\\w+)%')
+    while True:
+        m = pattern.search(data, pos)
+        if m is None:
+            break
+        name = m.group(1)
+        if name in placeholders:
+            segments += [literal + data[pos : m.start(0)], name]
+            literal = ''
+            pos = m.end(0)
+        else:
+            print('Warning: unknown placeholder %' + name + '% in template!')
+            literal += data[pos : m.start(0) + 1]
+            pos = m.start(0) + 1
+    segments.append(literal + data[pos :])
+    return segments
+
+
+
+def refhashes(wikiname):
+    """
+    return the hashes of the bib entries cited in wikiname, None for keys not in the bib
+    """
+    hashes = {}
+    for key in getmeta(wikiname)['keys']:
+        try:
+            hashes[key] = bibentryhash(bibfilename, key)
+        except KeyNotInBib:
+            hashes[key] = None
+    return hashes
+
+
+
+def loadmanifest():
+    """
+    load the manifest of the last build from cachedir, starting afresh if there is none
+    """
+    manifest.clear()
+    try:
+        data = json.load(open(cachedir + 'manifest.json', 'r'))
+        if data.get('version') == manifestversion:
+            manifest.update(data)
+    except (IOError, OSError, ValueError):
+        pass
+    manifest['version'] = manifestversion
+    manifest.setdefault('pages', {})
+
+
+
+def savemanifest():
+    """
+    write the manifest of this build to cachedir
+    """
+    ensuredir(cachedir)
+    with open(cachedir + 'manifest.json', 'w') as f:
+        json.dump(manifest, f, sort_keys=True)
+
+
+
+def manifestentry(wikiname):
+    """
+    return the manifest entry of wikiname, creating it if needed
+    """
+    return manifest.setdefault('pages', {}).setdefault(wikiname, {})
+
+
+
+def forgetpage(wikiname):
+    """
+    drop a page which is no longer in the namelist from the manifest, the content stash and the terms,
+    together with its output if that was not replaced since
+    """
+    entry = manifest['pages'].pop(wikiname)
+    for name in (stashname(wikiname), termsname(wikiname)):
+        if path.isfile(name):
+            os.remove(name)
+    htmlname = htmldir + wikiname + '.html'
+    if entry.get('output') is not None and path.isfile(htmlname):
+        if digestfile(htmlname) == entry['output']:
+            removeoutput(htmlname)
+
+
+
+def writeoutput(filename, data):
+    """
+    write data, a string or a list of chunks, to filename through a temporary file and a rename,
+    unless filename already holds exactly data; the chunks are written one by one, never joined
+    return the hash of data
+    """
+    chunks = [data] if isinstance(data, str) else data
+    h = digest(chunks)
+    ondisk = diskhashes.pop(filename, None)
+    if ondisk is None and path.isfile(filename):
+        ondisk = digestfile(filename)
+    if ondisk != h:
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'w') as f:
+            f.writelines(chunks)
+        os.replace(tmpname, filename)
+    if gziplevel is not None and (ondisk != h or gzipstate['all'] or not sidecarcurrent(filename)):
+        gzipoutput(filename, chunks)
+    return h
+
+
+
+def removeoutput(filename):
+    """
+    remove an output file together with its .gz sidecar
+    """
+    os.remove(filename)
+    if path.isfile(filename + '.gz'):
+        os.remove(filename + '.gz')
+
+
+
+def sidecarcurrent(filename):
+    """
+    check whether filename.gz exists and is not older than filename
+    """
+    stamp = filestamp(filename)
+    sidecar = filestamp(filename + '.gz')
+    return stamp is not None and sidecar is not None and sidecar[0] >= stamp[0]
+
+
+
+def gzipoutput(filename, chunks):
+    """
+    compress the chunks just written to filename into filename.gz on the gzip thread pool,
+    so that the page assembly goes on meanwhile, see finishgzip(), or right away in a worker process
+    """
+    encoding = locale.getpreferredencoding(False)
+    if gzipstate['threads'] == 0:
+        countgzip(writegzip(filename + '.gz', chunks, encoding, gziplevel))
+        return
+    if gzipstate['pool'] is None:
+        gzipstate['pool'] = concurrent.futures.ThreadPoolExecutor(gzipstate['threads'])
+    gzipstate['jobs'].append(gzipstate['pool'].submit(writegzip, filename + '.gz', chunks, encoding, gziplevel))
+
+
+
+def writegzip(filename, chunks, encoding, level):
+    """
+    write the chunks, encoded with encoding, gzip compressed at level to filename, through a temporary
+    file and a rename; the header carries no name or time, so the same text always gives the same file
+    return the number of bytes written, which the caller counts, see countgzip(), as this may run on
+    a gzip thread while any stage is running
+    """
+    c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    tmpname = filename + '.tmp'
+    with builtins.open(tmpname, 'wb') as f:
+        for chunk in chunks:
+            f.write(c.compress(chunk.encode(encoding)))
+        f.write(c.flush())
+        written = f.tell()
+    os.replace(tmpname, filename)
+    return written
+
+
+
+def countgzip(written):
+    """
+    count a sidecar of written bytes from writegzip() in iocounters when profiling, against the
+    stage running now: the page compressed in a worker process, or finishgzip for the gzip threads
+    """
+    if profile is not None:
+        iocounters['opens'] += 1
+        iocounters['written'] += written
+
+
+
+def finishgzip():
+    """
+    wait for the pending compressions of gzipoutput(), raising the first error
+    """
+    jobs = gzipstate['jobs']
+    gzipstate['jobs'] = []
+    for job in jobs:
+        countgzip(job.result())
+
+
+
+def outputhashes():
+    """
+    return the hash of every file the last build wrote, by its name relative to htmldir:
+    the pages, as wikiname.html, and the other outputs recorded in manifest['files']
+    """
+    hashes = dict(manifest.get('files', {}))
+    for name, entry in manifest['pages'].items():
+        if entry.get('output') is not None:
+            hashes[name + '.html'] = entry['output']
+    if manifest.get('gzip') is not None:
+        for name in list(hashes):
+            hashes[name + '.gz'] = hashes[name] + '-' + str(manifest['gzip'])
+    return hashes
+
+
+
+def writedelta(previous):
+    """
+    compare the outputs of this build with previous, see outputhashes(), and write the added,
+    changed and deleted output files relative to htmldir to cachedir/delta.json
+    """
+    current = outputhashes()
+    delta = {'added': [], 'changed': [], 'deleted': []}
+    for name in sorted(set(previous) | set(current)):
+        old = previous.get(name)
+        new = current.get(name)
+        if old == new:
+            continue
+        if new is None:
+            delta['deleted'].append(name)
+        elif old is None:
+            delta['added'].append(name)
+        else:
+            delta['changed'].append(name)
+    ensuredir(cachedir)
+    with open(cachedir + 'delta.json', 'w') as f:
+        json.dump(delta, f, indent=1, sort_keys=True)
+    print('Output: %d added, %d changed, %d deleted' % (len(delta['added']), len(delta['changed']), len(delta['deleted'])))
+    return delta
+
+
+
+def stashname(wikiname):
+    """
+    file in cachedir keeping the %content% of wikiname, since assemble() overwrites the vimwiki export
+    """
+    return cachedir + 'content/' + wikiname + '.html'
+
+
+
+def digest(data):
+    """
+    content hash of a string, or of the concatenation of a list of strings
+    """
+    if isinstance(data, str):
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+    h = hashlib.sha1()
+    for chunk in data:
+        h.update(chunk.encode('utf-8'))
+    return h.hexdigest()
+
+
+
+def digestfile(filename, blocksize=65536):
+    """
+    content hash of the text of filename, the same as digest() of its content, read in blocks
+    """
+    h = hashlib.sha1()
+    with open(filename, 'r') as f:
+        while True:
+            block = f.read(blocksize)
+            if block == '':
+                break
+            h.update(block.encode('utf-8'))
+    return h.hexdigest()
+
+
+
+def filestamp(filename):
+    """
+    return [mtime, size] of filename, or None if it does not exist
+    """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size]
+
+
+
+def ensuredir(dirname):
+    # several workers may create the same directory at once
+    os.makedirs(dirname, exist_ok=True)
+
+
+
+def runstage(stage, wikiname, f, *args):
+    """
+    return f(*args), recording it as stage of wikiname, or of the whole site if wikiname is None,
+    when profiling is on
+    """
+    if profile is None:
+        return f(*args)
+    io = dict(iocounters)
+    memory = profile['memory']
+    if memory is not None:
+        start, before = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        # the peaks of the stages f runs, which reset the traced peak in turn
+        memory.append(0)
+    t = time.perf_counter()
+    try:
+        return f(*args)
+    finally:
+        t = time.perf_counter() - t
+        records = profile['site'] if wikiname is None else profile['pages'].setdefault(wikiname, {})
+        r = records.setdefault(stage, {'time': 0.0, 'calls': 0, 'opens': 0, 'read': 0, 'written': 0})
+        r['time'] += t
+        r['calls'] += 1
+        for k in io:
+            r[k] += iocounters[k] - io[k]
+        if memory is not None:
+            peak = max(tracemalloc.get_traced_memory()[1], memory.pop())
+            if memory:
+                memory[-1] = max(memory[-1], before, peak)
+            r['peak'] = max(r.get('peak', 0), peak - start)
+
+
+
+def startprofile(memory=False):
+    """
+    turn on the instrumentation of the build: every stage run through runstage() records its
+    wall time, how many files it opened and how many bytes (characters for text files) it read and
+    wrote; the bib file, which is memory mapped when it is scanned, counts as an open but not as
+    bytes read. if memory is set it also records the most memory the stage had allocated at once,
+    as traced by tracemalloc, which slows the build down several times, so its times only compare
+    with each other
+    """
+    global profile
+    profile = {'site': {}, 'pages': {}, 'memory': [] if memory else None}
+    if memory:
+        tracemalloc.start()
+    for module in (sys.modules[__name__], bib2html):
+        module.open = countingopen
+
+
+
+def peakmemory():
+    """
+    peak resident memory of this process in bytes, 0 where the resource module is missing
+    """
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+
+def countingopen(*args, **kwargs):
+    """
+    open() counting the file and what is read and written through it in iocounters
+    """
+    f = builtins.open(*args, **kwargs)
+    iocounters['opens'] += 1
+    return CountingFile(f)
+
+
+
+class CountingFile(object):
+    """
+    a file object adding the bytes or characters read and written through it to iocounters
+    """
+    def __init__(self, f):
+        self.f = f
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.f.close()
+
+    def __iter__(self):
+        for line in self.f:
+            iocounters['read'] += len(line)
+            yield line
+
+    def read(self, *args):
+        data = self.f.read(*args)
+        iocounters['read'] += len(data)
+        return data
+
+    def readline(self, *args):
+        data = self.f.readline(*args)
+        iocounters['read'] += len(data)
+        return data
+
+    def readinto(self, b):
+        n = self.f.readinto(b)
+        iocounters['read'] += n or 0
+        return n
+
+    def write(self, data):
+        iocounters['written'] += len(data)
+        return self.f.write(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+
+
+def mergestages(records, stages):
+    """
+    add the measurements of stages, stage -> measurements as runstage() records them, to records
+    """
+    for stage, r in stages.items():
+        total = records.setdefault(stage, dict.fromkeys(r, 0))
+        for k in r:
+            total[k] = max(total[k], r[k]) if k == 'peak' else total[k] + r[k]
+
+
+
+def writeprofile(elapsed):
+    """
+    write the measurements of this build to cachedir/profile.json and print the slowest stages and pages
+    the time of a stage includes the stages it runs, e.g. assemble includes generatereflist
+    """
+    stages = {}
+    for records in [profile['site']] + list(profile['pages'].values()):
+        mergestages(stages, records)
+    report = {'time': elapsed, 'peak': peakmemory(), 'stages': stages, 'site': profile['site'],
+              'pages': profile['pages'], 'traced': profile['memory'] is not None}
+    ensuredir(cachedir)
+    with builtins.open(cachedir + 'profile.json', 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    print('Profile: %.3fs, peak memory %.1f MB, report in %sprofile.json' % (elapsed, report['peak'] / 1048576.0, cachedir))
+    if report['traced']:
+        print('Memory was traced: the times are inflated, profile without --profile-memory to time the build')
+    print('Slowest stages:')
+    for stage in sorted(stages, key=lambda s: -stages[s]['time'])[: 5]:
+        r = stages[stage]
+        print('  %-20s %8.3fs %6d calls %6d opens %10d read %10d written' %
+              (stage, r['time'], r['calls'], r['opens'], r['read'], r['written']))
+    pages = profile['pages']
+    slowest = sorted([n for n in pages if 'assemble' in pages[n]], key=lambda n: -pages[n]['assemble']['time'])
+    if slowest != []:
+        print('Slowest pages:')
+    for name in slowest[: 5]:
+        r = pages[name]['assemble']
+        print('  %-20s %8.3fs %6d opens %10d read %10d written' % (name, r['time'], r['opens'], r['read'], r['written']))
 
 
 
@@ -107,42 +1315,261 @@ def vimwikihtml2content(wikiname):
     truncate the html converted from wiki using vimwiki to the portion fit in %content% in the template
     """
     htmlname = htmldir + wikiname + '.html'
-    html = open(htmlname, 'r')
-    data = html.read()
+    entry = manifestentry(wikiname)
+    if (entry.get('output') is not None and entry.get('html') is not None and
+            entry['html'] == filestamp(htmlname) and path.isfile(stashname(wikiname))):
+        # htmlname is still our own output of the last build, as its stamp tells without reading it
+        diskhashes[htmlname] = entry['output']
+        return open(stashname(wikiname), 'r').read()
+    data = open(htmlname, 'r').read()
+    diskhashes[htmlname] = digest(data)
+    if entry.get('output') == diskhashes[htmlname] and path.isfile(stashname(wikiname)):
+        # htmlname was touched but is still our own output, not a fresh vimwiki export
+        return open(stashname(wikiname), 'r').read()
     pos1 = data.find('<body>')
     pos2 = data.find('</body>')
     data = data[pos1 + 6 : pos2]
+    h = digest(data)
+    if entry.get('content') != h or not path.isfile(stashname(wikiname)):
+        ensuredir(cachedir + 'content/')
+        with open(stashname(wikiname), 'w') as f:
+            f.write(data)
+        entry['content'] = h
+        entry.pop('native', None)
     return data
 
 
 
+def wikicontent(wikiname):
+    """
+    convert wikiname.wiki to the html fit in %content% with wiki2html, reusing the conversion
+    kept in the content stash as long as wikiname.wiki and the converter are unchanged
+    """
+    wikifile = wikidir + wikiname + '.wiki'
+    entry = manifestentry(wikiname)
+    if entry.get('native') == nativestamp(wikiname) and path.isfile(stashname(wikiname)):
+        return open(stashname(wikiname), 'r').read()
+    data = wiki2html.convert(open(wikifile, 'r').read())[0]
+    ensuredir(cachedir + 'content/')
+    with open(stashname(wikiname), 'w') as f:
+        f.write(data)
+    entry['content'] = digest(data)
+    entry['native'] = nativestamp(wikiname)
+    return data
+
+
+
+def nativestamp(wikiname):
+    """
+    what a conversion of wikiname.wiki by wiki2html depends on: [mtime, size, converter version]
+    """
+    stamp = filestamp(wikidir + wikiname + '.wiki')
+    return None if stamp is None else stamp + [wiki2html.version]
+
+
+
 def navbar(wikiname):
     """
-    assemble the left navbar of wikiname.html
+    assemble the left navbar of wikiname.html from the pre-rendered navbar as a list of chunks,
+    swapping in the unlinked entry of wikiname; only the block holding that entry is copied
+    with sharednav set, only the reference to the shared navigation, see navfiles()
     """
-    listfile = open(configdir + 'wikilist', 'r')
-    data = ''
-    data += '<ul>'
-    while True:
-        n = listfile.readline().replace('\n', '')
-        if n == '':
-            break
+    if sharednav:
+        return [navreference % html.escape(wikiname, True)]
+    if not navcache:
+        buildnavbar()
+    blocks = navcache['blocks']
+    span = navcache['spans'].get(wikiname)
+    if span is None:
+        return blocks
+    block, start, end, current = span
+    text = blocks[block]
+    return blocks[: block] + [text[: start] + current + text[end :]] + blocks[block + 1 :]
+
+
+
+# number of navbar entries per block of navcache['blocks']
+navblocksize = 64
+
+
+
+def buildnavbar():
+    """
+    pre-render the navbar once with every entry linked, in blocks of navblocksize entries,
+    recording for each wikiname in which block and where its <li> sits and what it becomes
+    on its own page; with sharednav set, build the tree of the shared navigation instead
+    """
+    if sharednav:
+        pages = collections.OrderedDict((n, gettitle(n)) for n in iternames())
+        navcache.update({'blocks': [], 'spans': {}, 'tree': navtree(list(pages.items()))})
+        return
+    blocks = []
+    items = ['<ul>']
+    spans = {}
+    pos = len(items[0])
+    for n in iternames():
+        if len(items) == navblocksize:
+            blocks.append(''.join(items))
+            items = []
+            pos = 0
         t = gettitle(n)
-        if n != wikiname:
-            data += '<li><a href="' + n + '.html">' + t + '</a></li>'
+        item = '<li><a href="' + n + '.html">' + t + '</a></li>'
+        if n not in spans:
+            spans[n] = (len(blocks), pos, pos + len(item), '<li>' + t + '</li>')
+        items.append(item)
+        pos += len(item)
+    items.append('</ul>')
+    blocks.append(''.join(items))
+    navcache['blocks'] = blocks
+    navcache['spans'] = spans
+
+
+
+def navtree(pages, depth=0):
+    """
+    group [(wikiname, title)] by the namespaces and prefixes of the wikinames, the parts split by
+    navseparators, into the nodes of the shared navigation: [wikiname, title] for a page and
+    [label, nodes] for the pages sharing a prefix, in the order of their first page; a prefix of
+    a single page makes no group
+    """
+    groups = collections.OrderedDict()
+    for name, title in pages:
+        parts = navseparators.split(name)
+        label = parts[depth] if len(parts) > depth + 1 else (None, name)
+        groups.setdefault(label, []).append((name, title))
+    nodes = []
+    for label, members in groups.items():
+        if isinstance(label, tuple) or len(members) == 1:
+            nodes.extend([name, title] for name, title in members)
         else:
-            data += '<li>' + t + '</li>'
-    data += '</ul>'
-    return data
+            nodes.append([html.escape(label), navtree(members, depth + 1)])
+    return nodes
+
+
+
+def navfiles():
+    """
+    the files of the shared navigation, by their name relative to htmldir: nav.json holding the
+    tree of navtree() and nav.js, the loader rendering it into the pages
+    """
+    if not navcache:
+        buildnavbar()
+    return {'nav.json': json.dumps(navcache['tree'], separators=(',', ':'), ensure_ascii=False),
+            'nav.js': navscript}
+
+
+
+def writenav():
+    """
+    write the shared navigation to htmldir, see navfiles()
+    """
+    outputs = manifest.setdefault('files', {})
+    files = navfiles()
+    for f in files:
+        outputs[f] = writeoutput(htmldir + f, files[f])
+
+
+
+def removenav():
+    """
+    remove the shared navigation written by an earlier build with sharednav set
+    """
+    for f in [f for f in manifest.get('files', {}) if f in ('nav.json', 'nav.js')]:
+        forgetoutput(f)
+
+
+
+# what a page carries of the shared navigation: the element nav.js fills and the name of the page
+navreference = '<div id="vwweb-nav" data-current="%s"></div><script src="nav.js"></script>'
+
+# the loader of the shared navigation: renders nav.json into #vwweb-nav as nested lists like the
+# inline navbar, the entry of the current page unlinked
+navscript = r'''(function () {
+  var el = document.getElementById('vwweb-nav');
+  if (!el) return;
+  var current = el.getAttribute('data-current');
+  var base = document.currentScript.src.replace(/[^\/]*$/, '');
+  function render(nodes) {
+    var out = '<ul>';
+    nodes.forEach(function (n) {
+      if (typeof n[1] !== 'string') out += '<li>' + n[0] + render(n[1]) + '</li>';
+      else if (n[0] === current) out += '<li>' + n[1] + '</li>';
+      else out += '<li><a href="' + n[0] + '.html">' + n[1] + '</a></li>';
+    });
+    return out + '</ul>';
+  }
+  fetch(base + 'nav.json').then(function (r) { return r.json(); }).then(function (tree) {
+    el.innerHTML = render(tree);
+    if (window.MathJax && MathJax.typesetPromise) MathJax.typesetPromise([el]);
+    else if (window.MathJax && MathJax.Hub) MathJax.Hub.Queue(['Typeset', MathJax.Hub, el]);
+  });
+})();
+'''
+
 
 
 def getdate(wikiname):
     """
-    parse the date of wikiname.wiki
+    return the date of wikiname from the page index
+    """
+    return getmeta(wikiname)['date']
+
+
+
+def gettitle(wikiname):
+    """
+    return the title of wikiname from the page index
+    """
+    return getmeta(wikiname)['title']
+
+
+
+def getmeta(wikiname):
+    """
+    return the metadata of wikiname, scanning wikiname.wiki only if it is not in the page index yet
+    """
+    meta = pageindex.get(wikiname)
+    if meta is None:
+        meta = readmeta(wikiname)
+        pageindex[wikiname] = meta
+    return meta
+
+
+
+def buildindex():
+    """
+    rebuild the page index, reading each wiki in the namelist exactly once
+    """
+    pageindex.clear()
+    for name in iternames():
+        getmeta(name)
+
+
+
+def readmeta(wikiname):
+    """
+    read wikiname.wiki once and parse its title, date and citation keys
+    """
+    stamp = filestamp(wikidir + wikiname + '.wiki')
+    entry = manifest.get('pages', {}).get(wikiname)
+    if entry is not None and entry.get('wiki') == stamp and 'meta' in entry:
+        return entry['meta']
+    data = open(wikidir + wikiname + '.wiki', 'r').read()
+    meta = {}
+    meta['title'] = parsetitle(wikiname, data)
+    meta['date'] = parsedate(wikiname, data)
+    bibkeylist = list(set(re.findall('\[\{(.*?)\}\]', data)))
+    bibkeylist.sort()
+    meta['keys'] = bibkeylist
+    return meta
+
+
+
+def parsedate(wikiname, data):
+    """
+    parse the date of wikiname from the content of wikiname.wiki
     if %date field exists then use it, otherwise print a warning and use file modification date
     """
-    wikifile = open(wikidir + wikiname + '.wiki', 'r')
-    data = wikifile.read()
     pos = data.find('%date')
     if pos == -1:
         print('Warning: ' + wikiname + ' has no date placeholder! Using file modification date...')
@@ -155,14 +1582,12 @@ def getdate(wikiname):
 
 
 
-def gettitle(wikiname):
+def parsetitle(wikiname, data):
     """
-    parse the title of wikiname.wiki.
+    parse the title of wikiname from the content of wikiname.wiki.
     If %title field exists then use it, otherwise use wikiname
     TODO: print warning when no %title exists
     """
-    wikifile = open(wikidir + wikiname + '.wiki', 'r')
-    data = wikifile.read()
     pos = data.find('%title')
     if pos == -1:
         return wikiname
@@ -195,44 +1620,416 @@ def genlist():
 
 
 
-def removebrokenlinks(html):
+def removebrokenlinks(html, wikiname=None):
     """
     check if a hyper link has a correponding wiki in wikidir
     if not the strip the link.
 
-    this only works assuming the links ends with html (with or without anchor)
-    """
-    ap1 = html.find('<a href')
-    result = html[: ap1]
-    while ap1 != -1:
-        ap2 = html.find('>', ap1)
-        ap3 = html.find('</a>', ap2)
-        ap4 = ap3 + 4
-        linkp1 = html.find('"', ap1 + 1)
-        linkp2 = html.find('"', linkp1 + 1)
-        linkp3 = html.find('#', linkp1 + 1, linkp2) #process links with anchors
-        if linkp3 == -1:
-            linkpath = html[linkp1 + 1 : linkp2 - 5]
-        else:
-            linkpath = html[linkp1 + 1 : linkp3 - 5]
-        linkpath = wikidir + linkpath + '.wiki'
-        if (not path.isfile(linkpath)) and (html[linkp1 + 1: linkp1 + 5] != 'http'):
-            delta = html[ap2 + 1 : ap3]
-        else:
-            delta = html[ap1 : ap4]
-        ap1 = html.find('<a href', ap4)
-        result += delta + html[ap4 : ap1]
-    result += html[-1]
-    return result
+    anchors are tokenized in one pass and the targets checked against the set of known
+    pages, so no file is looked at per link. links with a scheme (http:, mailto:, ...),
+    links within the page (#anchor) and relative links to files other than .html are kept.
+    if wikiname is given, the pages html links to and its broken links are recorded in
+    the manifest entry of wikiname.
+    """
+    if not knownpages:
+        buildknownpages()
+    result = []
+    links = set()
+    broken = set()
+    pos = 0
+    for m in anchorpattern.finditer(html):
+        target = anchortarget(m.group(1))
+        if target is None:
+            continue
+        if target in knownpages:
+            links.add(target)
+            continue
+        broken.add(target)
+        result.append(html[pos : m.start(0)])
+        result.append(m.group(2))
+        pos = m.end(0)
+    result.append(html[pos :])
+    if wikiname is not None:
+        links.discard(wikiname)
+        entry = manifestentry(wikiname)
+        entry['links'] = sorted(links)
+        entry['broken'] = sorted(broken)
+    return ''.join(result)
+
+
+
+def anchortarget(attrs):
+    """
+    return the wikiname the attributes of an anchor after '<a href' point to, see linktarget()
+    """
+    m = re.search('"(.*?)"', attrs)
+    if m is None:
+        return None
+    return linktarget(m.group(1))
+
+
+
+def linktarget(link):
+    """
+    return the wikiname a link points to, or None if it is not a link to a page of the wiki
+    """
+    if link == '' or link[0] == '#' or link.startswith('//') or schemepattern.match(link):
+        return None
+    link = link.split('#', 1)[0].split('?', 1)[0]
+    if not link.endswith('.html'):
+        return None
+    return link[: -5]
+
+
+
+def buildknownpages():
+    """
+    collect the wikinames of all .wiki files under wikidir, including subdirectories, and
+    bibliographyname when the bibliography is written, so links to it are not stripped
+    """
+    knownpages.clear()
+    templatecache.clear()
+    for dirpath, dirnames, filenames in os.walk(wikidir):
+        prefix = path.relpath(dirpath, wikidir).replace(os.sep, '/')
+        prefix = '' if prefix == '.' else prefix + '/'
+        for f in filenames:
+            if f.endswith('.wiki'):
+                knownpages.add(prefix + f[: -5])
+    if bibliography:
+        knownpages.add(bibliographyname)
+
+
 
 def addplaintexttag(wikiname):
     """
     add plaintext tag so that github won't recognise the wiki files as markdown
+    wikis which already start with the tag, or have not changed since the last build, are left alone
     """
-    data = open(wikidir + wikiname + '.wiki', 'r').read()
-    data = '%%<!-- -*- mode: text; -*- -->\n' + data
-    open(wikidir + wikiname + '.wiki', 'w').write(data)
+    wikifile = wikidir + wikiname + '.wiki'
+    entry = manifestentry(wikiname)
+    if entry.get('wiki') is not None and entry['wiki'] == filestamp(wikifile):
+        return
+    data = open(wikifile, 'r').read()
+    if not data.startswith(plaintexttag):
+        converted = entry.get('native') is not None and entry['native'] == nativestamp(wikiname)
+        with open(wikifile, 'w') as f:
+            f.write(plaintexttag + data)
+        if converted:
+            # the tag is a comment, so the conversion still holds
+            entry['native'] = nativestamp(wikiname)
+    entry['wiki'] = filestamp(wikifile)
 
-if __name__ == '__main__':
+
+
+def watch(interval=0.2, debounce=0.3, jobs=1):
+    """
+    keep rebuilding the pages affected by changes to the wikis, the vimwiki exports, the template, the citation style or the bib file
+    the directories are polled every interval seconds and a rebuild starts once nothing changed for debounce seconds;
+    the page index, manifest and bib index stay in memory between rebuilds
+    """
     genlist()
-    assembleall()
+    assembleall(incremental=True, jobs=jobs)
+    before = watchsnapshot()
+    print('Watching ' + wikidir + ', ' + htmldir + ', ' + configdir + 'default.tpl, ' + configdir +
+          'citationstyle.json and ' + bibfilename)
+    try:
+        while True:
+            time.sleep(interval)
+            now = watchsnapshot()
+            if now == before:
+                continue
+            while True:
+                time.sleep(debounce)
+                later = watchsnapshot()
+                if later == now:
+                    break
+                now = later
+            changed = sorted(f for f in set(before) | set(now) if before.get(f) != now.get(f))
+            print('Changed: ' + ', '.join(changed))
+            if [f for f in changed if f.startswith(wikidir)]:
+                genlist()
+            t = time.time()
+            assembleall(incremental=True, jobs=jobs)
+            print('Rebuilt in %.3fs' % (time.time() - t))
+            before = watchsnapshot()
+            for name, entry in manifest['pages'].items():
+                # an export which landed while we were building still counts as a change
+                htmlname = htmldir + name + '.html'
+                if htmlname in before and before[htmlname] != entry.get('html'):
+                    before[htmlname] = None
+    except KeyboardInterrupt:
+        pass
+
+
+
+def watchsnapshot():
+    """
+    return filename -> [mtime, size] of every file watched by watch()
+    """
+    stamps = {}
+    for dirname, ext in ((wikidir, '.wiki'), (htmldir, '.html')):
+        for f in listdir(dirname):
+            if f.endswith(ext):
+                stamps[dirname + f] = filestamp(dirname + f)
+    for f in (configdir + 'default.tpl', configdir + 'citationstyle.json', bibfilename):
+        stamps[f] = filestamp(f)
+    return stamps
+
+
+
+# {'pages', 'size', 'version', 'livereload', 'lock'}: state of serve(), the pages rendered so far
+# as wikiname -> bytes in least recently used order, how many of them are kept, a counter bumped
+# on every change to the sources, whether pages reload themselves when it moves, and the lock
+# around rendering and invalidation
+servestate = {'pages': collections.OrderedDict(), 'size': 256, 'version': 0, 'livereload': False,
+              'lock': threading.Lock()}
+
+# appended to served pages with live reload on, polling the version of serve()
+livereloadscript = '''<script>(function (v) { setInterval(function () {
+  fetch('/__vwweb__/version').then(function (r) { return r.text(); })
+    .then(function (t) { if (t != v) location.reload(); }, function () {});
+}, 1000); })('%d');</script>
+'''
+
+
+
+def serve(port=8000, interval=0.2, livereload=False, size=256):
+    """
+    serve htmldir on port, rendering wikiname.html on request with render() instead of reading it,
+    so no build is needed to preview a change; the page index, navbar, template and bib index stay
+    in memory, the last size pages rendered are kept, and the sources are polled every interval
+    seconds to drop what changed; with livereload the open pages reload themselves after a change
+    nothing is written to htmldir
+    """
+    servestate.update({'size': size, 'livereload': livereload})
+    genlist()
+    loadmanifest()
+    loadcitationstyle()
+    buildindex()
+    buildnavbar()
+    buildknownpages()
+    if 'backlinks' in gettemplate()['segments'][1::2]:
+        buildlinkgraph()
+    loadbib(bibfilename)
+    handler = functools.partial(ServeHandler, directory=htmldir)
+    server = http.server.ThreadingHTTPServer(('', port), handler)
+    poller = threading.Thread(target=servepoll, args=(interval,))
+    poller.daemon = True
+    poller.start()
+    print('Serving ' + htmldir + ' at http://localhost:%d/' % port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+
+def servepage(wikiname):
+    """
+    return the bytes of wikiname.html, rendering it unless it is among the pages kept by serve(),
+    or None if wikiname is not a page of the wiki; the page index is looked up under the lock,
+    since servepoll() empties and refills it when the sources change
+    """
+    pages = servestate['pages']
+    with servestate['lock']:
+        if wikiname not in pageindex:
+            return None
+        data = pages.get(wikiname)
+        if data is not None:
+            pages.move_to_end(wikiname)
+            return data
+        chunks, values = render(wikiname)
+        if minifyhtml:
+            chunks = htmlmin.minify(chunks)[0]
+        page = ''.join(chunks)
+        if servestate['livereload']:
+            pos = page.rfind('</body>')
+            pos = len(page) if pos == -1 else pos
+            page = page[: pos] + livereloadscript % servestate['version'] + page[pos :]
+        data = page.encode('utf-8')
+        pages[wikiname] = data
+        while len(pages) > servestate['size']:
+            pages.popitem(last=False)
+        return data
+
+
+
+def servepoll(interval):
+    """
+    poll the sources of serve() every interval seconds: a new vimwiki export only drops its page,
+    any other change brings the page index, navbar and known pages up to date and drops every page
+    """
+    before = watchsnapshot()
+    while True:
+        time.sleep(interval)
+        now = watchsnapshot()
+        if now == before:
+            continue
+        changed = [f for f in set(before) | set(now) if before.get(f) != now.get(f)]
+        exports = [f[len(htmldir) : -5] for f in changed if f.startswith(htmldir)]
+        with servestate['lock']:
+            backlinked = 'backlinks' in gettemplate()['segments'][1::2]
+            if len(exports) == len(changed) and not backlinked:
+                for name in exports:
+                    servestate['pages'].pop(name, None)
+            else:
+                if len(exports) < len(changed):
+                    genlist()
+                    loadcitationstyle()
+                    buildindex()
+                    buildnavbar()
+                    buildknownpages()
+                if backlinked:
+                    for name in exports:
+                        if name in pageindex:
+                            pagecontent(name)
+                    buildlinkgraph()
+                servestate['pages'].clear()
+            servestate['version'] += 1
+        print('Changed: ' + ', '.join(sorted(changed)))
+        before = now
+
+
+
+class ServeHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    request handler of serve(): pages of the wiki are rendered, everything else is served from htmldir
+    """
+    def do_GET(self):
+        urlpath = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        if urlpath == '/__vwweb__/version':
+            self.reply(200, 'text/plain', str(servestate['version']).encode('utf-8'))
+            return
+        if urlpath.endswith('/'):
+            urlpath += 'index.html'
+        if sharednav and urlpath in ('/nav.json', '/nav.js'):
+            with servestate['lock']:
+                data = navfiles()[urlpath[1 :]].encode('utf-8')
+            self.reply(200, 'application/json' if urlpath.endswith('.json') else 'text/javascript', data)
+            return
+        name = urlpath[1 : -5] if urlpath.endswith('.html') else None
+        try:
+            data = servepage(name) if name is not None else None
+        except Exception:
+            self.reply(500, 'text/plain', traceback.format_exc().encode('utf-8'))
+            return
+        if data is None:
+            http.server.SimpleHTTPRequestHandler.do_GET(self)
+            return
+        self.reply(200, 'text/html; charset=utf-8', data)
+
+    def reply(self, code, contenttype, data):
+        self.send_response(code)
+        self.send_header('Content-Type', contenttype)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(data)
+
+
+
+# placeholder in the template -> function of wikiname returning its html
+placeholders = {
+    'title': gettitle,
+    'index': navbar,
+    'content': pagecontent,
+    'references': generatereflist,
+    'date': getdate,
+    'backlinks': backlinks,
+}
+
+# placeholders whose html needs no pass of removebrokenlinks(): the navbar and backlinks only
+# link to known pages and pagecontent() strips the broken links of the content itself
+checkedplaceholders = set(['index', 'content', 'backlinks'])
+
+
+
+def buildsites(sites, incremental=False, jobs=1):
+    """
+    build every site in turn in this process, each with jobs processes assembling its pages
+    a bib file shared by several sites is parsed once and each of its entries rendered once per citation style
+    return a dict htmldir -> errors of the sites with failed pages
+    """
+    failed = {}
+    previous = currentsite()
+    try:
+        for site in sites:
+            usesite(site)
+            print('building ' + site.htmldir)
+            genlist()
+            errors = assembleall(incremental=incremental, jobs=jobs)
+            if errors:
+                failed[site.htmldir] = errors
+    finally:
+        usesite(previous)
+    return failed
+
+
+
+def main():
+    global searchindex, gziplevel, nativeconverter, bibliography, minifyhtml, sharednav
+    parser = argparse.ArgumentParser(description='generate a wiki website from vimwiki')
+    parser.add_argument('command', nargs='?', default='build', choices=['build', 'watch', 'serve'],
+                        help='build the site once (default), keep rebuilding it as sources change, '
+                        'or serve it, rendering pages on request')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='only assemble the pages whose inputs changed since the last build')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes assembling pages in parallel (0 for one per CPU)')
+    parser.add_argument('-s', '--search', action='store_true',
+                        help='write a client side search index of the pages to htmldir/search/')
+    parser.add_argument('-n', '--native', action='store_true',
+                        help='convert the .wiki files with wiki2html instead of using the vimwiki html exports')
+    parser.add_argument('-b', '--bibliography', action='store_true',
+                        help='write the cited entries, with the pages citing them, to htmldir/' + bibliographyname + '.html')
+    parser.add_argument('-m', '--minify', action='store_true',
+                        help='collapse whitespace and drop comments of the pages, reporting the bytes saved to cachedir/minify.json')
+    parser.add_argument('--shared-nav', action='store_true',
+                        help='write the navigation once to htmldir/nav.json, loaded by nav.js, instead of into every page')
+    parser.add_argument('-z', '--gzip', type=int, nargs='?', const=9, metavar='LEVEL',
+                        help='also write a .gz of every output, compressed at zlib level LEVEL (default 9)')
+    parser.add_argument('--port', type=int, default=8000, help='port of serve (default 8000)')
+    parser.add_argument('--livereload', action='store_true',
+                        help='with serve, reload the pages open in a browser when the sources change')
+    parser.add_argument('--sites', metavar='FILE',
+                        help='build the sites listed in the json file FILE in one process instead of the configured one')
+    parser.add_argument('-p', '--profile', action='store_true',
+                        help='time every stage of every page and write a report to cachedir/profile.json')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='profile as --profile does and trace the peak memory of every stage, which slows the build down')
+    args = parser.parse_args()
+    if args.profile or args.profile_memory:
+        startprofile(args.profile_memory)
+    if args.search:
+        searchindex = True
+    if args.gzip is not None:
+        gziplevel = args.gzip
+    if args.native:
+        nativeconverter = True
+    if args.bibliography:
+        bibliography = True
+    if args.minify:
+        minifyhtml = True
+    if args.shared_nav:
+        sharednav = True
+    jobs = args.jobs if args.jobs > 0 else multiprocessing.cpu_count()
+    if args.sites:
+        if args.command != 'build':
+            parser.error('--sites only works with build')
+        if buildsites(loadsites(args.sites), incremental=args.incremental, jobs=jobs):
+            sys.exit(1)
+        return
+    if args.command == 'watch':
+        watch(jobs=jobs)
+        return
+    if args.command == 'serve':
+        serve(port=args.port, livereload=args.livereload)
+        return
+    genlist()
+    errors = assembleall(incremental=args.incremental, jobs=jobs)
+    if errors:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
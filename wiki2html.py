@@ -0,0 +1,462 @@
+#-------------------------------------------------------------------------------
+# Copyright (c) 2017 Yuchen Pei
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#-------------------------------------------------------------------------------
+
+"""
+convert vimwiki markup to html, so that pages need not be exported by vim first
+
+convert(text) returns the html which :Vimwiki2HTML puts between <body> and </body>,
+together with the %title, %date, %template and %nohtml placeholders of the page.
+covered are headers, paragraphs, typefaces, links and images, bulleted, numbered and
+definition lists with checkboxes, preformatted and math blocks, inline math, tables
+with spans, blockquotes, horizontal rules and comments.
+"""
+
+import html
+import re
+
+# bumped whenever the html produced for the same markup changes, so cached conversions are redone
+version = 1
+
+# html tags which may be written in the markup as they are; any other < and > are escaped
+validtags = ['b', 'i', 's', 'u', 'sub', 'sup', 'kbd', 'br', 'hr']
+
+placeholderpattern = re.compile('^%(title|date|template|nohtml)(?:\\s+(.*?))?\\s*$')
+headerpattern = re.compile('^(\\s*)(={1,6})\\s*(.*?)\\s*(={1,6})\\s*$')
+rulepattern = re.compile('^-{4,}\\s*$')
+prestartpattern = re.compile('^\\s*\\{\\{\\{(.*)$')
+preendpattern = re.compile('^\\s*\\}\\}\\}\\s*$')
+mathstartpattern = re.compile('^\\s*\\{\\{\\$(?:%(.*?)%)?\\s*$')
+mathendpattern = re.compile('^\\s*\\}\\}\\$\\s*$')
+tablepattern = re.compile('^(\\s*)\\|.*\\|\\s*$')
+tableseparatorpattern = re.compile('^\\s*\\|[-:|\\s]*-[-:|\\s]*\\|\\s*$')
+listpattern = re.compile('^(\\s*)([-*#]|\\d+[.)]|[a-z]\\)|[A-Z]\\)|[ivxlcdm]+\\)|[IVXLCDM]+\\))\\s+(?:\\[([ .oOX-])\\]\\s*)?(.*)$')
+definitionpattern = re.compile('^(?:(\\S.*?)\\s*)?::(?:\\s+(.*?))?\\s*$')
+quotepattern = re.compile('^(?:\\s{4,}|\\t|> ?)(.*)$')
+commentstartpattern = re.compile('^\\s*%%\\+')
+commentendpattern = re.compile('\\+%%\\s*$')
+
+codepattern = re.compile('`([^`]+)`')
+mathpattern = re.compile('\\$([^$\\s](?:[^$]*[^$\\s])?)\\$')
+wikilinkpattern = re.compile('\\[\\[(.+?)\\]\\]')
+mdlinkpattern = re.compile('\\[([^\\[\\]]+)\\]\\(([^()\\s]+)\\)')
+imagepattern = re.compile('\\{\\{(.+?)\\}\\}')
+urlpattern = re.compile('(?:https?|ftp|mailto):[^\\s<>"\']+[^\\s<>"\'.,;:!?)]')
+tagpattern = re.compile('</?(?:' + '|'.join(validtags) + ')(?:\\s[^<>]*)?/?>')
+entitypattern = re.compile('&(?:[a-zA-Z]+|#[0-9]+|#x[0-9a-fA-F]+);')
+schemepattern = re.compile('^[a-zA-Z][a-zA-Z0-9+.-]*:')
+typefaces = [
+    (re.compile('(?<![\\w*])\\*(\\S|\\S.*?\\S)\\*(?![\\w*])'), '<strong>', '</strong>'),
+    (re.compile('(?<![\\w_])_(\\S|\\S.*?\\S)_(?![\\w_])'), '<em>', '</em>'),
+    (re.compile('~~(.+?)~~'), '<del>', '</del>'),
+    (re.compile('\\^(.+?)\\^'), '<sup><small>', '</small></sup>'),
+    (re.compile(',,(.+?),,'), '<sub><small>', '</small></sub>'),
+]
+todopattern = re.compile('\\b(TODO|DONE|STARTED|FIXME|FIXED|XXX)\\b')
+stashpattern = re.compile('\x00(\\d+)\x00')
+
+checkboxes = {' ': 'done0', '.': 'done1', 'o': 'done2', 'O': 'done3', 'X': 'done4', '-': 'rejected'}
+
+
+
+def convert(text):
+    """
+    convert the vimwiki markup text to html, returning (html, placeholders) where placeholders
+    maps the names of the %title, %date, %template and %nohtml lines found to their values
+    """
+    c = Converter()
+    for line in text.splitlines():
+        c.feed(line)
+    c.feed(None)
+    return '\n' + '\n'.join(c.out) + '\n', c.placeholders
+
+
+
+class Converter(object):
+    """
+    a line by line converter: feed() it the lines of a page and then None, and the html
+    is in out, one block element or line per item
+    """
+    def __init__(self):
+        self.out = []
+        self.placeholders = {}
+        # the open block: None, 'p', 'quote', 'dl', 'pre', 'math', 'comment', 'table' or 'list'
+        self.block = None
+        self.lines = []
+        # the open lists, innermost last, as [indent, tag, lines of the open item]
+        self.lists = []
+
+    def feed(self, line):
+        if line is None:
+            self.close()
+            return
+        if self.block == 'pre':
+            if preendpattern.match(line):
+                self.out.append(self.lines[0] + '\n'.join(self.lines[1 :]) + '\n</pre>')
+                self.block = None
+            else:
+                self.lines.append(escape(line))
+            return
+        if self.block == 'math':
+            if mathendpattern.match(line):
+                env = self.lines[0]
+                body = '\n'.join(self.lines[1 :])
+                if env:
+                    self.out.append('\\begin{' + env + '}\n' + body + '\n\\end{' + env + '}')
+                else:
+                    self.out.append('\\[\n' + body + '\n\\]')
+                self.block = None
+            else:
+                self.lines.append(escape(line))
+            return
+        if self.block == 'comment':
+            if commentendpattern.search(line):
+                self.block = None
+            return
+        if line.lstrip().startswith('%%'):
+            if commentstartpattern.match(line) and not commentendpattern.search(line):
+                self.close()
+                self.block = 'comment'
+            return
+        m = placeholderpattern.match(line)
+        if m is not None:
+            self.placeholders[m.group(1)] = m.group(2) or ''
+            return
+        if line.strip() == '':
+            self.close()
+            return
+        m = prestartpattern.match(line)
+        if m is not None:
+            self.close()
+            attrs = m.group(1).strip()
+            if attrs != '' and '=' not in attrs:
+                attrs = 'class="' + escape(attrs) + '"'
+            self.block = 'pre'
+            self.lines = ['<pre' + (' ' + attrs if attrs else '') + '>\n']
+            return
+        m = mathstartpattern.match(line)
+        if m is not None:
+            self.close()
+            self.block = 'math'
+            self.lines = [m.group(1) or '']
+            return
+        m = headerpattern.match(line)
+        if m is not None and len(m.group(2)) == len(m.group(4)) and m.group(3) != '':
+            self.close()
+            self.header(len(m.group(2)), m.group(3), m.group(1) != '')
+            return
+        if rulepattern.match(line):
+            self.close()
+            self.out.append('<hr />')
+            return
+        m = tablepattern.match(line)
+        if m is not None:
+            if self.block != 'table':
+                self.close()
+                self.block = 'table'
+                self.lines = [m.group(1) != '']
+            self.lines.append(line)
+            return
+        m = listpattern.match(line)
+        if m is not None:
+            if self.block != 'list':
+                self.close()
+                self.block = 'list'
+            self.listitem(len(m.group(1).expandtabs()), m.group(2), m.group(3), m.group(4))
+            return
+        if self.block == 'list' and len(line) - len(line.lstrip()) > self.lists[-1][0]:
+            self.lists[-1][2].append(inline(line.strip()))
+            return
+        m = definitionpattern.match(line)
+        if m is not None and (m.group(1) is not None or m.group(2) is not None):
+            if self.block != 'dl':
+                self.close()
+                self.block = 'dl'
+                self.lines = []
+            if m.group(1) is not None:
+                self.lines.append('<dt>' + inline(m.group(1)) + '</dt>')
+            if m.group(2) is not None:
+                self.lines.append('<dd>' + inline(m.group(2)) + '</dd>')
+            return
+        m = quotepattern.match(line)
+        if m is not None and self.block != 'p':
+            if self.block != 'quote':
+                self.close()
+                self.block = 'quote'
+                self.lines = []
+            self.lines.append(inline(m.group(1).strip()))
+            return
+        if self.block not in ('p', 'quote'):
+            self.close()
+            self.block = 'p'
+            self.lines = []
+        self.lines.append(inline(line.strip()))
+
+    def close(self):
+        """
+        write out the open block
+        """
+        if self.block == 'p':
+            self.out.append('<p>\n' + '\n'.join(self.lines) + '\n</p>')
+        elif self.block == 'quote':
+            self.out.append('<blockquote>\n' + '\n'.join(self.lines) + '\n</blockquote>')
+        elif self.block == 'dl':
+            self.out.append('<dl>\n' + '\n'.join(self.lines) + '\n</dl>')
+        elif self.block == 'table':
+            self.out.append(table(self.lines[1 :], self.lines[0]))
+        elif self.block == 'list':
+            while self.lists:
+                self.closelist()
+        elif self.block == 'pre':
+            self.out.append(self.lines[0] + '\n'.join(self.lines[1 :]) + '\n</pre>')
+        self.block = None
+        self.lines = []
+
+    def header(self, level, text, centered):
+        anchor = escape(html.unescape(text), True)
+        cls = 'header justcenter' if centered else 'header'
+        h = 'h' + str(level)
+        self.out.append('<div id="' + anchor + '"><' + h + ' id="' + anchor + '" class="' + cls + '"><a href="#' +
+                        anchor + '">' + inline(text) + '</a></' + h + '></div>')
+
+    def listitem(self, indent, bullet, checkbox, text):
+        tag, attrs = listtag(bullet)
+        while self.lists and indent < self.lists[-1][0]:
+            self.closelist()
+        if self.lists and indent == self.lists[-1][0]:
+            if self.lists[-1][1] == tag + attrs:
+                self.closeitem()
+            else:
+                self.closelist()
+        if not self.lists or indent > self.lists[-1][0]:
+            # a nested list goes into the open item of the enclosing list
+            target = self.lists[-1][2] if self.lists else self.out
+            target.append('<' + tag + attrs + '>')
+            self.lists.append([indent, tag + attrs, None])
+        item = '<li class="' + checkboxes[checkbox] + '">' if checkbox is not None else '<li>'
+        self.lists[-1][2] = [item + inline(text)]
+
+    def closeitem(self):
+        lines = self.lists[-1][2]
+        target = self.lists[-2][2] if len(self.lists) > 1 else self.out
+        target.append('\n'.join(lines) + '</li>')
+
+    def closelist(self):
+        self.closeitem()
+        indent, tagattrs, lines = self.lists.pop()
+        target = self.lists[-1][2] if self.lists else self.out
+        target.append('</' + tagattrs.split(' ')[0] + '>')
+
+
+
+def listtag(bullet):
+    """
+    return the tag and the attributes of a list with the given bullet
+    """
+    if bullet in ('-', '*'):
+        return 'ul', ''
+    if bullet == '#' or bullet[0].isdigit():
+        return 'ol', ''
+    if re.match('^[ivxlcdm]+\\)$', bullet) and (len(bullet) > 2 or bullet == 'i)'):
+        return 'ol', ' type="i"'
+    if re.match('^[IVXLCDM]+\\)$', bullet) and (len(bullet) > 2 or bullet == 'I)'):
+        return 'ol', ' type="I"'
+    return 'ol', ' type="' + ('a' if bullet[0].islower() else 'A') + '"'
+
+
+
+def table(rows, centered):
+    """
+    convert the lines of a table to html; a separator line |---| turns the rows above it into the
+    header, a cell > is joined to the cell on its left and a cell \\/ to the cell above it, unless
+    there is no such cell
+    """
+    head = []
+    body = []
+    for row in rows:
+        if tableseparatorpattern.match(row):
+            head, body = head + body, []
+        else:
+            body.append(splitrow(row))
+    grid = head + body
+    spans = {}
+    merged = set()
+    for i, cells in enumerate(grid):
+        for j, cell in enumerate(cells):
+            if cell.strip() == '>' and j > 0:
+                k = j - 1
+                while k > 0 and (i, k) in merged:
+                    k -= 1
+                spans.setdefault((i, k), [1, 1])[1] += 1
+                merged.add((i, j))
+            elif cell.strip() == '\\/' and i > 0 and j < len(grid[i - 1]):
+                k = i - 1
+                while k > 0 and (k, j) in merged:
+                    k -= 1
+                spans.setdefault((k, j), [1, 1])[0] += 1
+                merged.add((i, j))
+    out = ['<table class="center">' if centered else '<table>']
+    for part, start, rowsof, celltag in (('thead', 0, head, 'th'), ('tbody', len(head), body, 'td')):
+        if rowsof == []:
+            continue
+        if head != []:
+            out.append('<' + part + '>')
+        for i in range(start, start + len(rowsof)):
+            out.append('<tr>')
+            for j, cell in enumerate(grid[i]):
+                if (i, j) in merged:
+                    continue
+                attrs = ''
+                rowspan, colspan = spans.get((i, j), [1, 1])
+                if rowspan > 1:
+                    attrs += ' rowspan="' + str(rowspan) + '"'
+                if colspan > 1:
+                    attrs += ' colspan="' + str(colspan) + '"'
+                out.append('<' + celltag + attrs + '>' + inline(cell.strip()) + '</' + celltag + '>')
+            out.append('</tr>')
+        if head != []:
+            out.append('</' + part + '>')
+    out.append('</table>')
+    return '\n'.join(out)
+
+
+
+def splitrow(row):
+    """
+    split a table line into its cells, leaving alone the | of [[target|description]] links
+    """
+    row = row.strip()[1 : -1]
+    cells = []
+    depth = 0
+    start = 0
+    i = 0
+    while i < len(row):
+        if row.startswith('[[', i):
+            depth += 1
+            i += 2
+        elif row.startswith(']]', i) and depth > 0:
+            depth -= 1
+            i += 2
+        elif row[i] == '|' and depth == 0:
+            cells.append(row[start : i])
+            start = i = i + 1
+        else:
+            i += 1
+    cells.append(row[start :])
+    return cells
+
+
+
+def inline(text):
+    """
+    convert the inline markup of a line: code, math, links, images, urls and typefaces
+    code, math and the generated tags are set aside first so that the typefaces do not reach into them
+    """
+    stash = []
+    # a NUL of the line itself would be taken for a stashed fragment
+    text = text.replace('\x00', '')
+
+    def keep(fragment):
+        stash.append(fragment)
+        return '\x00' + str(len(stash) - 1) + '\x00'
+
+    text = codepattern.sub(lambda m: keep('<code>' + escape(m.group(1)) + '</code>'), text)
+    text = mathpattern.sub(lambda m: keep('\\(' + escape(m.group(1)) + '\\)'), text)
+    text = wikilinkpattern.sub(lambda m: keep(wikilink(m.group(1))), text)
+    text = mdlinkpattern.sub(lambda m: keep('<a href="' + escape(m.group(2), True) + '">' + escape(m.group(1)) + '</a>'), text)
+    text = imagepattern.sub(lambda m: keep(image(m.group(1))), text)
+    text = urlpattern.sub(lambda m: keep('<a href="' + escape(m.group(0), True) + '">' + escape(m.group(0)) + '</a>'), text)
+    text = tagpattern.sub(lambda m: keep(m.group(0)), text)
+    text = escape(text)
+    for pattern, start, end in typefaces:
+        text = pattern.sub(lambda m: start + m.group(1) + end, text)
+    text = todopattern.sub('<span class="todo">\\1</span>', text)
+    while '\x00' in text:
+        text = stashpattern.sub(lambda m: stash[int(m.group(1))], text)
+    return text
+
+
+
+def wikilink(link):
+    """
+    convert the inside of [[target|description]] to an anchor
+    """
+    target, sep, description = link.partition('|')
+    target = target.strip()
+    if sep == '':
+        body = escape(target)
+    elif imagepattern.match(description.strip()):
+        body = image(imagepattern.match(description.strip()).group(1))
+    else:
+        body = escape(description.strip())
+    return '<a href="' + escape(linkurl(target), True) + '">' + body + '</a>'
+
+
+
+def linkurl(target):
+    """
+    the url of the target of a wiki link: pages get .html, anchors and urls are kept
+    """
+    if target.startswith('#'):
+        return target
+    if target.startswith('diary:'):
+        target = 'diary/' + target[6 :]
+    elif target.startswith('local:') or target.startswith('file:'):
+        return target.split(':', 1)[1]
+    elif schemepattern.match(target):
+        return target
+    target, hashsign, anchor = target.partition('#')
+    target = target.lstrip('/')
+    if target.endswith('/'):
+        return target + hashsign + anchor
+    return target + '.html' + hashsign + anchor
+
+
+
+def image(transclusion):
+    """
+    convert the inside of {{url|alt|attributes}} to an image
+    """
+    parts = transclusion.split('|')
+    url = parts[0].strip()
+    if url.startswith('local:') or url.startswith('file:'):
+        url = url.split(':', 1)[1]
+    img = '<img src="' + escape(url, True) + '"'
+    if len(parts) > 1 and parts[1].strip() != '':
+        img += ' alt="' + escape(parts[1].strip(), True) + '"'
+    if len(parts) > 2 and parts[2].strip() != '':
+        img += ' ' + parts[2].strip()
+    return img + ' />'
+
+
+
+def escape(text, quote=False):
+    """
+    escape &, < and > (and " with quote) for html, leaving character references alone
+    """
+    pos = 0
+    out = []
+    for m in entitypattern.finditer(text):
+        out.append(html.escape(text[pos : m.start(0)], quote))
+        out.append(m.group(0))
+        pos = m.end(0)
+    out.append(html.escape(text[pos :], quote))
+    return ''.join(out)